@@ -1,10 +1,23 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, session, Response, stream_with_context
 import os
 from werkzeug.utils import secure_filename
 import json
 import random # 导入 random 模块
 import battle # 导入 battle 模块
+import damage
+import step_codec
+from battle_store import BattleStore
+from replay_store import ReplayStore
+from odds import OddsCache
+from matchup_cache import MatchupCache
+from matchup_matrix import MatchupMatrix
+import lockstep
+import simulation
+import tournament
+from jobs import JobQueue, JobQueueFull
+from fighter import FLUCTUATION, MAX_TURNS, battle_view
 import uuid # 用于生成唯一的战斗ID
+from repository import ELEMENTS, repository
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24) # 设置一个随机的密钥，用于session
@@ -12,9 +25,19 @@ DATA_FILE = 'data/characters.json'
 UPLOAD_FOLDER = 'static/assets'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav'}
 
-ELEMENTS = ['金', '木', '水', '火', '土', '风', '雷', '毒', '法', '圣', '精神']
-
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+battle_store = BattleStore() # 宝可梦式对战状态保存在服务端，session 中只保存战斗ID
+MAX_SESSION_BATTLES = 10
+replay_store = ReplayStore() # 已结束的对战回放，/battle_result/<replay_id> 读取
+odds_cache = OddsCache() # 1v1 精确胜率，角色变更时由仓库通知失效
+repository.add_listener(odds_cache.invalidate)
+matchup_matrix = MatchupMatrix(repository, odds_cache) # 全员 1v1 胜率矩阵，后台线程按行列增量更新
+repository.add_listener(matchup_matrix.invalidate) # 在 odds_cache 之后注册，重算时旧结果已失效
+matchup_cache = MatchupCache() # 模拟对局统计，按角色内容哈希缓存，角色变更时只丢弃相关对局
+repository.add_listener(matchup_cache.invalidate)
+MAX_MATCHUP_BATTLES = 100000
+MAX_SYNC_MATCHUP_WORK = 20000 # /api/matchup 在请求内最多模拟 对战数 × 参战人数；更大的请求转为后台任务
+job_queue = JobQueue() # 长时间的模拟（大乱斗、循环赛、大样本对局统计）在后台线程池中运行，请求只拿到任务ID
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
@@ -25,68 +48,23 @@ def allowed_file(filename):
 os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
 
 def load_characters():
-    if not os.path.exists(DATA_FILE):
-        return []
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        characters = json.load(f).get('characters', [])
-        for char in characters:
-            # 确保skills中的damage字段是字典
-            for i, skill_item in enumerate(char.get('skills', [])):
-                if isinstance(skill_item, str):
-                    # 如果技能是字符串，转换为字典格式
-                    char['skills'][i] = {
-                        'name': skill_item,
-                        'effect': '', # Add default effect
-                        'damage': {element: 0 for element in ELEMENTS}
-                    }
-                    skill_item = char['skills'][i] # 更新skill_item为新创建的字典
-                # 确保skills中的effect字段存在
-                if 'effect' not in skill_item:
-                    skill_item['effect'] = ''
-                # 确保skills中的damage字段是字典
-                if 'damage' not in skill_item or not isinstance(skill_item['damage'], dict):
-                    skill_item['damage'] = {element: 0 for element in ELEMENTS}
-                else:
-                    # 确保所有元素键都存在于damage字典中
-                    for element in ELEMENTS:
-                        if element not in skill_item['damage']:
-                            skill_item['damage'][element] = 0
-            
-            # Heuristic fix for '精神' damage transfer issue
-            # 确保attributes中的resistance字段是字典
-            for i, attr_item in enumerate(char.get('attributes', [])):
-                if isinstance(attr_item, str):
-                    # 如果属性是字符串，转换为字典格式
-                    char['attributes'][i] = {
-                        'name': attr_item,
-                        'resistance': {element: 0 for element in ELEMENTS}
-                    }
-                    attr_item = char['attributes'][i] # 更新attr_item为新创建的字典
-                # 确保attributes中的resistance字段是字典
-                if 'resistance' not in attr_item or not isinstance(attr_item['resistance'], dict):
-                    attr_item['resistance'] = {element: 0 for element in ELEMENTS}
-                else:
-                    # 确保所有元素键都存在于resistance字典中
-                    for element in ELEMENTS:
-                        if element not in attr_item['resistance']:
-                            attr_item['resistance'][element] = 0
-
-        return characters
+    """Returns the cached, normalized roster (read-only, shared across requests)."""
+    return repository.all()
 
 def save_characters(characters):
-    with open(DATA_FILE, 'w') as f:
-        json.dump({'characters': characters}, f, indent=2)
+    repository.save_all(characters)
 
 @app.route('/')
 def index():
     characters = load_characters()
     win_rates = battle.load_win_rates() # Load win rates
-    return render_template('index.html', characters=characters, win_rates=win_rates) # Pass win_rates to template
+    picks = matchup_matrix.picks(characters) # 读取后台线程算好的优势对局/克星，不等待、不重建矩阵
+    names = {char['id']: char['name'] for char in characters}
+    return render_template('index.html', characters=characters, win_rates=win_rates, picks=picks, names=names) # Pass win_rates to template
 
 @app.route('/edit/<int:char_id>', methods=['GET', 'POST'])
 def edit_character(char_id):
-    characters = load_characters()
-    character = next((c for c in characters if c['id'] == char_id), None)
+    character = repository.get_copy(char_id) # 可编辑的副本，保存时写回仓库
 
     if character is None:
         # 如果角色不存在，重定向到主页或显示错误
@@ -166,7 +144,7 @@ def edit_character(char_id):
                 audio.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
                 character['audio'] = filename
         
-        save_characters(characters)
+        repository.update(character)
         return redirect(url_for('index'))
     
     return render_template('edit.html', character=character)
@@ -177,10 +155,7 @@ def uploaded_file(filename):
 
 @app.route('/create', methods=['POST'])
 def create_character():
-    characters = load_characters()
-    new_id = max(c['id'] for c in characters) + 1 if characters else 1
-    characters.append({
-        'id': new_id,
+    character = repository.add({ # ID 由存储在锁内分配，多个进程同时创建也不会重复
         'name': '新角色',
         'stats': {
             'hp': 100
@@ -191,13 +166,11 @@ def create_character():
         'attributes': [], # 格式: [{"name": "火焰抗性", "resistance": {"火": 50, ...}}, ...]
         'element': '' # Default element
     })
-    save_characters(characters)
-    return redirect(url_for('edit_character', char_id=new_id))
+    return redirect(url_for('edit_character', char_id=character['id']))
 
 @app.route('/delete/<int:char_id>', methods=['POST'])
 def delete_character(char_id):
-    characters = load_characters()
-    character = next((c for c in characters if c['id'] == char_id), None)
+    character = repository.get(char_id)
     
     # 删除关联的文件
     if character:
@@ -210,8 +183,7 @@ def delete_character(char_id):
             if os.path.exists(audio_path):
                 os.remove(audio_path)
     
-    characters = [c for c in characters if c['id'] != char_id]
-    save_characters(characters)
+    repository.delete(char_id)
     return redirect(url_for('index'))
 
 @app.route('/api/characters', methods=['GET'])
@@ -220,55 +192,345 @@ def get_all_characters():
     characters = load_characters()
     return jsonify({"characters": characters})
 
-@app.route('/battle', methods=['GET'])
-def battle_characters():
-    """Handles character battle requests and returns detailed steps."""
-    characters = load_characters() # Use app's load_characters to ensure consistent data
-    
-    battle_mode = request.args.get('mode', '2v2') # Get battle mode, default to 2v2
+@app.route('/api/odds', methods=['GET'])
+def get_matchup_odds():
+    """Exact 1v1 odds of char1_id against char2_id, or against every other character if char2_id is omitted.
+
+    A single pair is solved on demand (and memoized). The roster-wide view is
+    the character's row of the background matchup matrix; while the matrix is
+    still updating it says ``pending`` and cells not computed yet are None.
+    """
+    char1 = repository.get(request.args.get('char1_id', type=int))
+    if char1 is None:
+        return jsonify({"error": "Unknown char1_id."}), 404
+    char2_id = request.args.get('char2_id', type=int)
+    if char2_id is None:
+        # 全员胜率不在请求中求解，直接读取后台矩阵的对应行
+        return jsonify(dict(matchup_matrix.row(char1['id']), character=char1['id']))
+    char2 = repository.get(char2_id)
+    if char2 is None:
+        return jsonify({"error": "Unknown char2_id."}), 404
+    return jsonify({
+        "character": char1['id'],
+        "odds": [dict(odds_cache.get(char1, char2), opponent=char2['id'])],
+    })
+
+def _select_battle_teams(characters, args=None):
+    """Reads the battle mode and character ids from the query string (or ``args``).
+
+    Besides 1v1, 2v2 and free_for_all, any battle.team_sizes mode ("5v5",
+    "50v50", "1v20", ...) is accepted with comma-separated ``team1`` and
+    ``team2`` id lists. Returns (battle_mode, team1, team2, error);
+    free-for-all puts every character in team1. ``error`` is a message for a
+    400 response.
+    """
+    args = request.args if args is None else args
+    battle_mode = args.get('mode', '2v2') # Get battle mode, default to 2v2
 
     if battle_mode == '1v1':
-        char1_id = request.args.get('char1_id', type=int)
-        char2_id = request.args.get('char2_id', type=int)
+        char1_id = args.get('char1_id', type=int)
+        char2_id = args.get('char2_id', type=int)
 
         if not char1_id or not char2_id:
-            return jsonify({"error": "Missing character IDs for 1v1 battle."}), 400
+            return battle_mode, [], [], "Missing character IDs for 1v1 battle."
 
-        team1, team2 = battle.select_characters(characters, [char1_id], [char2_id], battle_mode='1v1')
+        team1, team2 = battle.select_characters(characters, [char1_id], [char2_id], battle_mode='1v1', index=repository.index())
 
         if not team1 or not team2:
-            return jsonify({"error": "Could not select characters for 1v1 battle."}), 400
-        
-        battle_steps, final_result = battle.simulate_battle(team1, team2, battle_mode='1v1')
+            return battle_mode, [], [], "Could not select characters for 1v1 battle."
+        return battle_mode, team1, team2, None
 
     elif battle_mode == '2v2':
-        team1_char1_id = request.args.get('team1_char1_id', type=int)
-        team1_char2_id = request.args.get('team1_char2_id', type=int)
-        team2_char1_id = request.args.get('team2_char1_id', type=int)
-        team2_char2_id = request.args.get('team2_char2_id', type=int)
+        team1_char1_id = args.get('team1_char1_id', type=int)
+        team1_char2_id = args.get('team1_char2_id', type=int)
+        team2_char1_id = args.get('team2_char1_id', type=int)
+        team2_char2_id = args.get('team2_char2_id', type=int)
 
         if not all([team1_char1_id, team1_char2_id, team2_char1_id, team2_char2_id]):
-            return jsonify({"error": "Missing character IDs for 2v2 battle."}), 400
+            return battle_mode, [], [], "Missing character IDs for 2v2 battle."
 
         team1_ids = [team1_char1_id, team1_char2_id]
         team2_ids = [team2_char1_id, team2_char2_id]
         
-        team1, team2 = battle.select_characters(characters, team1_ids, team2_ids, battle_mode='2v2')
+        team1, team2 = battle.select_characters(characters, team1_ids, team2_ids, battle_mode='2v2', index=repository.index())
 
         if not team1 or not team2:
-            return jsonify({"error": "Could not select characters for 2v2 battle."}), 400
-
-        battle_steps, final_result = battle.simulate_battle(team1, team2, battle_mode='2v2')
+            return battle_mode, [], [], "Could not select characters for 2v2 battle."
+        return battle_mode, team1, team2, None
     elif battle_mode == 'free_for_all':
         # 大乱斗模式：所有角色参战
-        battle_steps, final_result = battle.simulate_battle_free_for_all(characters) # 新增函数
-    else:
-        return jsonify({"error": "Invalid battle mode specified."}), 400
+        if len(characters) < 2:
+            return battle_mode, [], [], "大乱斗模式至少需要两个角色。"
+        return battle_mode, list(characters), [], None # 战斗状态保存在 FighterState 中，不修改缓存
+    elif battle.team_sizes(battle_mode):
+        # NvM 模式：team1=1,2,3&team2=4,5,6
+        try:
+            team1_ids = [int(i) for i in args.get('team1', '').split(',') if i.strip()]
+            team2_ids = [int(i) for i in args.get('team2', '').split(',') if i.strip()]
+        except ValueError:
+            return battle_mode, [], [], f"Invalid character IDs for {battle_mode} battle."
+        if not team1_ids or not team2_ids:
+            return battle_mode, [], [], f"Missing character IDs for {battle_mode} battle."
+
+        team1, team2 = battle.select_characters(characters, team1_ids, team2_ids, battle_mode=battle_mode, index=repository.index())
 
-    return jsonify({
+        if not team1 or not team2:
+            return battle_mode, [], [], f"Could not select characters for {battle_mode} battle."
+        return battle_mode, team1, team2, None
+    return battle_mode, [], [], "Invalid battle mode specified."
+
+@app.route('/api/matchups', methods=['GET'])
+def get_matchup_matrix():
+    """The roster's 1v1 win-probability matrix (``pending`` while a background update is queued)."""
+    return jsonify(matchup_matrix.snapshot(load_characters()))
+
+def _batch_engine(fighters=2):
+    """(name, simulate_matchup) of the fastest batch simulator that handles ``fighters`` per battle."""
+    if lockstep.available() and fighters <= lockstep.MAX_FIGHTERS:
+        return 'lockstep', lockstep.simulate_matchup
+    return 'python', simulation.simulate_matchup # lockstep 的表随人数指数增长，人数多时用逐场模拟
+
+def _battle_job(battle_mode, team1, team2):
+    """Job function for one battle; its result is the /battle response."""
+    def run(job):
+        seed = battle.new_battle_seed()
+        participants = team1 + team2
+        if battle_mode == 'free_for_all':
+            events = battle.iter_battle_free_for_all(team1, seed=seed)
+        else:
+            events = battle.iter_battle(team1, team2, battle_mode=battle_mode, seed=seed)
+        steps = []
+        defeated = 0
+        try:
+            for step in events:
+                if step['event'] == 'defeated':
+                    defeated += 1
+                elif step['event'] == 'turn_start':
+                    # 每回合报告一次进度（按倒下人数估计），取消也在这里生效，未结束的战斗不记录胜率
+                    job.report(defeated / max(1, len(participants) - 1), {"event": "turn", "turn": step['turn'], "defeated": defeated})
+                steps.append(battle.with_message(step))
+        finally:
+            events.close()
+        record = battle.battle_record(battle_mode, seed, team1, team2)
+        replay_id = replay_store.save(record, battle.roster_snapshot(participants))
+        return {"steps": steps, "result": steps[-1]["result"], "replay_id": replay_id}
+    return run
+
+def _matchup_stats(battle_mode, team1, team2, battles):
+    """The /api/matchup response body (simulated or from the matchup cache)."""
+    engine, simulate = _batch_engine(len(team1) + len(team2))
+    stats = matchup_cache.get_or_simulate(team1, team2, battles, 0, engine, simulate)
+    return dict(stats, mode=battle_mode, team1=[c['id'] for c in team1], team2=[c['id'] for c in team2])
+
+def _matchup_job(battle_mode, team1, team2, battles):
+    """Job function for a large /api/matchup request; its result is the /api/matchup response."""
+    def run(job):
+        return _matchup_stats(battle_mode, team1, team2, battles)
+    return run
+
+def _tournament_job(characters, mode, battles, seed):
+    """Job function for a round robin; reports every pairing as it finishes."""
+    def run(job):
+        engine, simulate = _batch_engine(2 if mode == '1v1' else 4)
+        by_id = {c['id']: c for c in characters}
+        pairings = list(tournament.pairings(by_id, mode))
+        results = []
+        for i, (team1_ids, team2_ids) in enumerate(pairings):
+            stats = matchup_cache.get_or_simulate(
+                [by_id[c] for c in team1_ids], [by_id[c] for c in team2_ids], battles,
+                tournament.pairing_seed(seed, team1_ids, team2_ids), engine, simulate)
+            result = {
+                "team1": list(team1_ids),
+                "team2": list(team2_ids),
+                "wins": stats["wins"],
+                "losses": stats["losses"],
+                "draws": stats["draws"],
+                "mean_turns": stats["mean_turns"],
+            }
+            results.append(result)
+            job.report((i + 1) / len(pairings), dict(result, event="pairing"))
+        head_to_head, standings = tournament.merge_results(results)
+        return {"mode": mode, "seed": seed, "battles_per_pairing": battles, "head_to_head": head_to_head, "standings": standings}
+    return run
+
+def _submit_job(kind, func, params):
+    """Queues a job and returns the 202 response, or 503 when the queue is full."""
+    try:
+        job = job_queue.submit(kind, func, params)
+    except JobQueueFull as e:
+        return jsonify({"error": f"Too many simulations in progress: {e}"}), 503, {'Retry-After': '5'}
+    return jsonify({"job_id": job.id, "status_url": url_for('get_job', job_id=job.id)}), 202
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Starts a background simulation and returns its job id.
+
+    ``kind=battle`` takes the same parameters as /battle (any mode) and
+    finishes with the /battle response; ``kind=tournament`` runs a 1v1 or
+    2v2 round robin over the roster (``mode``, ``battles`` per pairing,
+    ``seed``).
+    """
+    kind = request.args.get('kind', 'battle')
+    characters = load_characters()
+    if kind == 'battle':
+        battle_mode, team1, team2, error = _select_battle_teams(characters)
+        if error:
+            return jsonify({"error": error}), 400
+        if battle_mode != 'free_for_all' and not battle.valid_teams(team1, team2, battle_mode):
+            return jsonify({"error": f"Invalid teams for {battle_mode} battle."}), 400
+        params = {"mode": battle_mode, "team1": [c['id'] for c in team1], "team2": [c['id'] for c in team2]}
+        return _submit_job(kind, _battle_job(battle_mode, team1, team2), params)
+    if kind == 'tournament':
+        mode = request.args.get('mode', '1v1')
+        if mode not in ('1v1', '2v2'):
+            return jsonify({"error": "Tournament mode must be 1v1 or 2v2."}), 400
+        battles = min(max(1, request.args.get('battles', 1000, type=int)), MAX_MATCHUP_BATTLES)
+        seed = request.args.get('seed', '0')
+        params = {"mode": mode, "battles": battles, "seed": seed}
+        return _submit_job(kind, _tournament_job(list(characters), mode, battles, seed), params)
+    return jsonify({"error": f"Unknown job kind: {kind}"}), 400
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status and progress; ``since=n`` also returns partial results from index n."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job."}), 404
+    return jsonify(job.to_dict(since=request.args.get('since', type=int)))
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """Streams a job's partial results as NDJSON, ending with its final status."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job."}), 404
+    since = request.args.get('since', 0, type=int)
+
+    def lines():
+        position = since
+        while True:
+            events, finished = job.wait(position, timeout=15)
+            position += len(events)
+            if events:
+                yield ''.join(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+            elif not finished:
+                # 长时间没有新结果时发送进度，保持连接
+                yield json.dumps({"event": "progress", "progress": job.progress}) + "\n"
+            if finished:
+                yield json.dumps(dict(job.to_dict(), event="end"), ensure_ascii=False) + "\n"
+                return
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson', headers=headers)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancels a queued or running job (running jobs stop at their next progress report)."""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/matchup', methods=['GET'])
+def get_matchup_stats():
+    """Simulated statistics (win rate, mean turns, damage dealt) of one team matchup.
+
+    Teams are chosen like ``/battle`` (free-for-all is not supported);
+    ``battles`` sets the sample size. Results are served from the matchup
+    cache while the participants are unchanged. An uncached request larger
+    than MAX_SYNC_MATCHUP_WORK (battles × fighters) runs as a background job
+    and gets a 202 with the job id instead (see /api/jobs).
+    """
+    battle_mode, team1, team2, error = _select_battle_teams(load_characters())
+    if error or battle_mode == 'free_for_all':
+        return jsonify({"error": error or "Matchup statistics need two teams."}), 400
+    battles = min(max(1, request.args.get('battles', 1000, type=int)), MAX_MATCHUP_BATTLES)
+    fighters = len(team1) + len(team2)
+    if battles * fighters > MAX_SYNC_MATCHUP_WORK:
+        engine, _ = _batch_engine(fighters)
+        if matchup_cache.get(team1, team2, battles, 0, engine) is None:
+            params = {"mode": battle_mode, "team1": [c['id'] for c in team1], "team2": [c['id'] for c in team2], "battles": battles}
+            return _submit_job('matchup', _matchup_job(battle_mode, team1, team2, battles), params)
+    return jsonify(_matchup_stats(battle_mode, team1, team2, battles))
+
+@app.route('/battle', methods=['GET'])
+def battle_characters():
+    """Handles character battle requests and returns detailed steps.
+
+    ``format=compact`` returns the step_codec encoding instead of verbose step dicts.
+    Every finished battle is stored in the replay store; ``replay_id`` in the
+    response addresses it at ``/battle_result/<replay_id>``. With ``async=1``
+    the battle runs as a background job instead (see /api/jobs).
+    """
+    characters = load_characters() # Use app's load_characters to ensure consistent data
+    battle_mode, team1, team2, error = _select_battle_teams(characters)
+    if error:
+        return jsonify({"error": error}), 400
+    if request.args.get('async') == '1':
+        if battle_mode != 'free_for_all' and not battle.valid_teams(team1, team2, battle_mode):
+            return jsonify({"error": f"Invalid teams for {battle_mode} battle."}), 400
+        params = {"mode": battle_mode, "team1": [c['id'] for c in team1], "team2": [c['id'] for c in team2]}
+        return _submit_job('battle', _battle_job(battle_mode, team1, team2), params)
+
+    seed = battle.new_battle_seed() # 每场战斗独立的随机种子，用于回放重现
+    battle_steps, final_result = battle.simulate_battle_by_mode(battle_mode, team1, team2, seed=seed)
+    compact = request.args.get('format') == 'compact'
+    return jsonify(_battle_response(battle_mode, seed, team1, team2, battle_steps, final_result, compact))
+
+def _battle_response(battle_mode, seed, team1, team2, battle_steps, final_result, compact=False):
+    """Stores the replay and builds the /battle response body (also used by asgi.py)."""
+    participants = team1 + team2
+    record = battle.battle_record(battle_mode, seed, team1, team2)
+
+    # 回放只保存种子和参战角色，打开时重新模拟生成步骤
+    replay_id = replay_store.save(record, battle.roster_snapshot(participants))
+
+    if compact:
+        # 紧凑格式：角色表只发送一次，步骤按列存储，消息由客户端按模板渲染
+        encoded = step_codec.encode_compact(battle_steps, final_result, participants)
+        return dict(encoded, replay_id=replay_id)
+
+    return {
         "steps": battle_steps,
-        "result": final_result
-    })
+        "result": final_result,
+        "replay_id": replay_id
+    }
+
+@app.route('/battle/stream', methods=['GET'])
+def battle_stream():
+    """Streams battle steps while they are computed (same query parameters as /battle).
+
+    The body is NDJSON, one step per line, flushed once per turn; with
+    ``format=sse`` (or ``Accept: text/event-stream``) each step is sent as a
+    Server-Sent Event instead. The final "end" step carries ``replay_id``.
+    """
+    characters = load_characters()
+    battle_mode, team1, team2, error = _select_battle_teams(characters)
+    if error:
+        return jsonify({"error": error}), 400
+
+    seed = battle.new_battle_seed()
+    record = battle.battle_record(battle_mode, seed, team1, team2)
+    roster = battle.roster_snapshot(team1 + team2)
+    if battle_mode == 'free_for_all':
+        events = battle.iter_battle_free_for_all(team1, seed=seed)
+    else:
+        events = battle.iter_battle(team1, team2, battle_mode=battle_mode, seed=seed)
+
+    sse = request.args.get('format') == 'sse' or request.accept_mimetypes.best == 'text/event-stream'
+
+    def encode(step):
+        line = json.dumps(step, ensure_ascii=False)
+        return f"data: {line}\n\n" if sse else line + "\n"
+
+    def attach_replay(step):
+        return dict(step, replay_id=replay_store.save(record, roster))
+
+    # 每个回合发送一次，客户端收到后即可开始播放
+    chunks = battle.stream_chunks(events, encode, on_end=attach_replay)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(chunks), mimetype='text/event-stream' if sse else 'application/x-ndjson', headers=headers)
 
 @app.route('/battle_result', methods=['GET'])
 def battle_result_page():
@@ -281,6 +543,20 @@ def battle_result_page():
         battle_steps = [] # Fallback to empty list if JSON is invalid
     return render_template('battle_result.html', final_result=final_result, battle_steps=battle_steps)
 
+@app.route('/battle_result/<replay_id>', methods=['GET'])
+def battle_replay_page(replay_id):
+    """Renders the battle result page for a stored replay."""
+    record = replay_store.get(replay_id)
+    roster = replay_store.get_roster(record.get('roster_hash')) if record else None
+    if roster is None:
+        return "回放不存在或已过期", 404
+    try:
+        battle_steps, final_result = battle.replay_battle(record, roster)
+    except ValueError as e:
+        print(f"Error: Could not replay battle {replay_id}: {e}")
+        return "回放无法重现（对战引擎已更新）", 410
+    return render_template('battle_result.html', final_result=final_result, battle_steps=battle_steps)
+
 @app.route('/douququ')
 def douququ_mode():
     """Renders the douququ mode page."""
@@ -300,11 +576,9 @@ def init_pokemon_battle():
     if not player1_id or not player2_id:
         return jsonify({"success": False, "message": "缺少玩家角色ID。"}), 400
 
-    characters = load_characters()
-    
     # 查找玩家选择的角色
-    player1_char = next((c for c in characters if c['id'] == int(player1_id)), None)
-    player2_char = next((c for c in characters if c['id'] == int(player2_id)), None)
+    player1_char = repository.get(int(player1_id))
+    player2_char = repository.get(int(player2_id))
 
     if not player1_char or not player2_char:
         return jsonify({"success": False, "message": "未找到指定角色。"}), 404
@@ -312,20 +586,9 @@ def init_pokemon_battle():
     # 初始化战斗状态
     battle_id = str(uuid.uuid4())
     
-    # 深拷贝角色数据，避免修改原始数据
-    p1_char_copy = json.loads(json.dumps(player1_char))
-    p2_char_copy = json.loads(json.dumps(player2_char))
-
-    # 初始化当前HP和战斗统计
-    p1_char_copy['current_hp'] = p1_char_copy['stats']['hp']
-    p1_char_copy['damage_dealt'] = 0
-    p1_char_copy['damage_taken'] = 0
-    p1_char_copy['healing_done'] = 0
-
-    p2_char_copy['current_hp'] = p2_char_copy['stats']['hp']
-    p2_char_copy['damage_dealt'] = 0
-    p2_char_copy['damage_taken'] = 0
-    p2_char_copy['healing_done'] = 0
+    # 只复制顶层字段并初始化当前HP和战斗统计；技能、属性等与角色缓存共享，战斗中只读
+    p1_char_copy = battle_view(player1_char)
+    p2_char_copy = battle_view(player2_char)
 
     # 随机决定哪个角色先行动
     first_attacker_id = random.choice([p1_char_copy['id'], p2_char_copy['id']])
@@ -345,10 +608,18 @@ def init_pokemon_battle():
         'battle_ended': False,
         'final_result_message': ''
     }
-    session[battle_id] = battle_state # 将战斗状态存储在session中
+    battle_store.save(battle_state) # 战斗状态保存在服务端
+    # session 中只记录该用户拥有的战斗ID
+    session['pokemon_battles'] = (session.get('pokemon_battles', []) + [battle_id])[-MAX_SESSION_BATTLES:]
 
     return jsonify({"success": True, "state": battle_state})
 
+def _pokemon_battle_response(battle_state, log_start):
+    """Saves the state and returns it without the full log, plus the entries added by this action."""
+    battle_store.save(battle_state)
+    state = {key: value for key, value in battle_state.items() if key != 'battle_log'}
+    return jsonify({"success": True, "state": state, "log": battle_state['battle_log'][log_start:]})
+
 @app.route('/api/pokemon_battle/action', methods=['POST'])
 def pokemon_battle_action():
     data = request.get_json()
@@ -359,7 +630,7 @@ def pokemon_battle_action():
     if not battle_id or not character_id or not skill_name:
         return jsonify({"success": False, "message": "缺少战斗ID、角色ID或技能名称。"}), 400
 
-    battle_state = session.get(battle_id)
+    battle_state = battle_store.get(battle_id) if battle_id in session.get('pokemon_battles', []) else None
     if not battle_state:
         return jsonify({"success": False, "message": "未找到战斗状态，请重新开始战斗。"}), 404
     
@@ -370,6 +641,7 @@ def pokemon_battle_action():
     if battle_state['active_character_id'] != character_id:
         return jsonify({"success": False, "message": "现在不是该角色行动。"}), 400
 
+    log_start = len(battle_state['battle_log'])
     attacker = next((c for c in battle_state['characters'] if c['id'] == character_id), None)
     if not attacker or attacker['current_hp'] <= 0:
         return jsonify({"success": False, "message": "行动角色无效或已阵亡。"}), 400
@@ -387,8 +659,7 @@ def pokemon_battle_action():
         battle_state['battle_ended'] = True
         battle_state['final_result_message'] = f"恭喜「{attacker['name']}」的队伍获得了胜利！"
         battle_state['battle_log'].append({"event": "end", "message": battle_state['final_result_message']})
-        session[battle_id] = battle_state
-        return jsonify({"success": True, "state": battle_state})
+        return _pokemon_battle_response(battle_state, log_start)
 
     # 随机选择一个活跃的对手作为防御者
     defender = random.choice(active_opponents)
@@ -404,18 +675,9 @@ def pokemon_battle_action():
     })
 
     # 计算伤害 (复用 battle.py 中的伤害计算逻辑)
-    total_damage = 0
-    for damage_type, base_damage in skill['damage'].items():
-        defender_resistance = 0
-        if 'attributes' in defender and defender['attributes']:
-            for attr in defender['attributes']:
-                if 'resistance' in attr and damage_type in attr['resistance']:
-                    defender_resistance = attr['resistance'][damage_type]
-                    break
-        actual_damage_for_type = max(0, base_damage - defender_resistance)
-        total_damage += actual_damage_for_type
+    total_damage = damage.skill_damage(skill, defender)
         
-    fluctuation_percentage = random.uniform(-0.15, 0.15)
+    fluctuation_percentage = random.uniform(-FLUCTUATION, FLUCTUATION)
     damage_dealt = total_damage * (1 + fluctuation_percentage)
     damage_dealt = max(0, round(damage_dealt))
 
@@ -449,24 +711,10 @@ def pokemon_battle_action():
             battle_state['final_result_message'] = f"恭喜「{winner_char_name}」的队伍获得了胜利！"
             battle_state['battle_log'].append({"event": "end", "message": battle_state['final_result_message']})
             
-            # 更新胜率 (简化处理，只更新获胜方)
-            win_rates = battle.load_win_rates()
-            winner_char_id = str(attacker['id'])
-            win_rates.setdefault(winner_char_id, {"total_battles": 0, "wins": 0})
-            win_rates[winner_char_id]["total_battles"] += 1
-            win_rates[winner_char_id]["wins"] += 1
-            battle.save_win_rates(win_rates)
-
-            # 更新所有参战角色的总战斗次数
-            for char in battle_state['characters']:
-                if str(char['id']) not in win_rates: # 如果是输家且之前没有记录
-                    win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-                if str(char['id']) != winner_char_id: # 输家只增加总战斗次数
-                    win_rates[str(char['id'])]["total_battles"] += 1
-            battle.save_win_rates(win_rates)
-
-            session[battle_id] = battle_state
-            return jsonify({"success": True, "state": battle_state})
+            # 更新胜率：获胜方记一胜，其余参战角色只增加总战斗次数
+            battle.record_battle_result([attacker['id']], [c['id'] for c in battle_state['characters'] if c['id'] != attacker['id']])
+
+            return _pokemon_battle_response(battle_state, log_start)
 
     # 切换到下一个行动角色
     all_active_characters = [c for c in battle_state['characters'] if c['current_hp'] > 0]
@@ -488,21 +736,15 @@ def pokemon_battle_action():
             battle_state['battle_log'].append({"event": "turn_start", "turn": battle_state['current_turn'], "message": f"--- 第 {battle_state['current_turn']} 回合 ---"})
             
             # 检查最大回合数
-            MAX_TURNS = 200 # 与 battle.py 保持一致
             if battle_state['current_turn'] > MAX_TURNS:
                 battle_state['battle_ended'] = True
                 battle_state['final_result_message'] = "战斗结束: 平局！(达到最大回合数)"
                 battle_state['battle_log'].append({"event": "end", "message": battle_state['final_result_message']})
                 
                 # 更新所有参战角色的总战斗次数 (平局)
-                win_rates = battle.load_win_rates()
-                for char in battle_state['characters']:
-                    win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-                    win_rates[str(char['id'])]["total_battles"] += 1
-                battle.save_win_rates(win_rates)
-
-                session[battle_id] = battle_state
-                return jsonify({"success": True, "state": battle_state})
+                battle.record_battle_result(loser_ids=[c['id'] for c in battle_state['characters']])
+
+                return _pokemon_battle_response(battle_state, log_start)
     else:
         # 所有角色都阵亡，平局
         battle_state['battle_ended'] = True
@@ -510,14 +752,9 @@ def pokemon_battle_action():
         battle_state['battle_log'].append({"event": "end", "message": battle_state['final_result_message']})
         
         # 更新所有参战角色的总战斗次数 (平局)
-        win_rates = battle.load_win_rates()
-        for char in battle_state['characters']:
-            win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-            win_rates[str(char['id'])]["total_battles"] += 1
-        battle.save_win_rates(win_rates)
+        battle.record_battle_result(loser_ids=[c['id'] for c in battle_state['characters']])
 
-    session[battle_id] = battle_state # 保存更新后的状态
-    return jsonify({"success": True, "state": battle_state})
+    return _pokemon_battle_response(battle_state, log_start) # 保存更新后的状态
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,348 @@
+"""ASGI entry point: serves the web app from an asyncio event loop.
+
+Run it with any ASGI server, e.g. ``uvicorn asgi:app`` (or ``python asgi.py``,
+which needs uvicorn). ``python app.py`` keeps working for development.
+Use a single server process: interactive battle states and background jobs
+live in process memory.
+
+- GET /battle is served natively. The simulation is CPU-bound and runs in
+  a process pool outside the GIL. Team selection, replay storage and
+  win-rate recording run in a small I/O thread pool, so the event loop only
+  parses the query and sends the response. Worker processes are started
+  with forkserver (spawn where unavailable), never forked from this
+  multi-threaded process, and are warmed up at lifespan startup.
+- Every other route runs the Flask view in a bounded thread pool. The
+  interactive battle routes (/api/pokemon_battle/...) have their own pool,
+  and so do the long-lived streams (/battle/stream, /api/jobs/<id>/stream),
+  so open streams can never queue action calls behind them. Actions on the
+  same battle id are serialized, so concurrent clicks cannot interleave on
+  one battle state; different battles proceed in parallel.
+- Backpressure: at most ``max_pending_battles`` simulations,
+  ``max_streams`` open streams and ``max_pending_requests`` other requests
+  are in flight at once. Beyond that a request gets 503 with Retry-After
+  immediately instead of waiting in an unbounded queue.
+"""
+import argparse
+import asyncio
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+import battle
+from app import _battle_response, _select_battle_teams, app as flask_app, load_characters
+
+BATTLE_WORKERS = os.cpu_count() or 1
+WSGI_THREADS = 32
+ACTION_THREADS = 32
+IO_THREADS = 8
+MAX_STREAMS = 32 # 每个打开的流占用一个线程
+MAX_PENDING_BATTLES = 256
+MAX_PENDING_REQUESTS = 512
+MAX_BODY_BYTES = 32 * 1024 * 1024 # 上传图片/音频的表单也经过这里
+RETRY_AFTER = '1' # 秒
+
+def _losers(participants, winners):
+    """Participant ids minus one occurrence of each winner (what battle_events records)."""
+    losers = [c['id'] for c in participants]
+    for char_id in winners:
+        losers.remove(char_id)
+    return losers
+
+def _is_stream(path):
+    return path == '/battle/stream' or (path.startswith('/api/jobs/') and path.endswith('/stream'))
+
+def _battle_id(body):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get('battle_id') if isinstance(data, dict) else None
+
+class AsgiApp:
+    """ASGI application wrapping the Flask ``wsgi_app`` (see module docstring).
+
+    ``battle_workers=0`` simulates in the I/O thread pool instead of worker
+    processes (for platforms or debuggers where a process pool is unwanted).
+    """
+
+    def __init__(self, wsgi_app, battle_workers=BATTLE_WORKERS, wsgi_threads=WSGI_THREADS, action_threads=ACTION_THREADS,
+                 io_threads=IO_THREADS, max_streams=MAX_STREAMS, max_pending_battles=MAX_PENDING_BATTLES,
+                 max_pending_requests=MAX_PENDING_REQUESTS, max_body_bytes=MAX_BODY_BYTES):
+        self.wsgi_app = wsgi_app
+        self.battle_workers = battle_workers
+        self.max_streams = max_streams
+        self.max_pending_battles = max_pending_battles
+        self.max_pending_requests = max_pending_requests
+        self.max_body_bytes = max_body_bytes
+        self._wsgi_threads = ThreadPoolExecutor(max_workers=wsgi_threads, thread_name_prefix='asgi-wsgi')
+        self._action_threads = ThreadPoolExecutor(max_workers=action_threads, thread_name_prefix='asgi-action')
+        self._stream_threads = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix='asgi-stream')
+        self._io_threads = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='asgi-io')
+        self._processes = None # 启动时（或首次对战时）创建
+        # 以下状态只在事件循环线程中修改，无需加锁
+        self._pending_battles = 0
+        self._pending_requests = 0
+        self._open_streams = 0
+        self._battle_locks = {} # battle_id -> [asyncio.Lock, 使用中的请求数]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == '/battle' and scope['method'] == 'GET':
+                args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+                if args.get('async') != '1': # async=1 提交后台任务，交给 Flask
+                    await self._battle(args, send)
+                    return
+            await self._wsgi(scope, receive, send)
+        # 不支持 websocket
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def start(self):
+        """Starts the battle worker processes and waits until each has imported the engine."""
+        executor = self._simulation_executor()
+        if executor is self._io_threads:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(self.battle_workers)))
+        except Exception as e:
+            print(f"Error: could not start battle worker processes: {e}")
+            self._processes = None # 首次对战时再试
+
+    def shutdown(self):
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+            self._processes = None
+        for executor in (self._wsgi_threads, self._action_threads, self._stream_threads, self._io_threads):
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _simulation_executor(self):
+        if self.battle_workers == 0:
+            return self._io_threads
+        if self._processes is None:
+            # 本进程有很多线程（WSGI 线程池、矩阵、账本），fork 出的子进程可能继承被占用的锁而死锁，
+            # 所以用 forkserver/spawn 启动干净的工作进程，并预先导入对战模块
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._processes = ProcessPoolExecutor(max_workers=self.battle_workers, mp_context=context,
+                                                  initializer=importlib.import_module, initargs=('battle',))
+        return self._processes
+
+    async def _send_json(self, send, status, data, headers=()):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _busy(self, send):
+        await self._send_json(send, 503, {"error": "Server is busy, please retry."}, [(b'retry-after', RETRY_AFTER.encode())])
+
+    async def _battle(self, args, send):
+        """GET /battle: same parameters and response as the Flask route."""
+        if self._pending_battles >= self.max_pending_battles:
+            await self._busy(send)
+            return
+        self._pending_battles += 1
+        loop = asyncio.get_running_loop()
+        try:
+            battle_mode, team1, team2, error = await loop.run_in_executor(
+                self._io_threads, lambda: _select_battle_teams(load_characters(), args))
+            if error:
+                await self._send_json(send, 400, {"error": error})
+                return
+            seed = battle.new_battle_seed()
+            try:
+                battle_steps, final_result = await loop.run_in_executor(
+                    self._simulation_executor(), battle.simulate_battle_by_mode, battle_mode, team1, team2, seed, False)
+            except BrokenProcessPool:
+                self._processes = None # 工作进程异常退出，下次请求重建进程池
+                raise
+            compact = args.get('format') == 'compact'
+            data = await loop.run_in_executor(
+                self._io_threads, self._finish_battle, battle_mode, seed, team1, team2, battle_steps, final_result, compact)
+        except Exception as e:
+            print(f"Error: battle request failed: {e}")
+            await self._send_json(send, 500, {"error": "Battle failed."})
+            return
+        finally:
+            self._pending_battles -= 1
+        await self._send_json(send, 200, data)
+
+    @staticmethod
+    def _finish_battle(battle_mode, seed, team1, team2, battle_steps, final_result, compact):
+        # 胜率在主进程中记录（工作进程不写账本）
+        if battle_steps:
+            battle.record_battle_result(battle_steps[-1]['winners'], _losers(team1 + team2, battle_steps[-1]['winners']))
+        return _battle_response(battle_mode, seed, team1, team2, battle_steps, final_result, compact)
+
+    async def _read_body(self, receive):
+        """The request body, or None if it exceeds max_body_bytes or the client went away."""
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _wsgi(self, scope, receive, send):
+        """Runs the Flask app for this request on the thread pool of its route group."""
+        if _is_stream(scope['path']):
+            if self._open_streams >= self.max_streams:
+                await self._busy(send)
+                return
+            self._open_streams += 1
+            try:
+                body = await self._read_body(receive)
+                if body is None:
+                    await self._send_json(send, 413, {"error": "Request body too large."})
+                    return
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._stream_threads, self._run_wsgi, self._environ(scope, body), send, loop)
+            finally:
+                self._open_streams -= 1
+            return
+        if self._pending_requests >= self.max_pending_requests:
+            await self._busy(send)
+            return
+        self._pending_requests += 1
+        try:
+            body = await self._read_body(receive)
+            if body is None:
+                await self._send_json(send, 413, {"error": "Request body too large."})
+                return
+            battle_id = _battle_id(body) if scope['path'] == '/api/pokemon_battle/action' else None
+            environ = self._environ(scope, body)
+            loop = asyncio.get_running_loop()
+            # 宝可梦式对战的请求有单独的线程池，不会排在其他路由后面
+            threads = self._action_threads if scope['path'].startswith('/api/pokemon_battle/') else self._wsgi_threads
+            if battle_id is None:
+                await loop.run_in_executor(threads, self._run_wsgi, environ, send, loop)
+                return
+            # 同一场战斗的行动依次执行，不同战斗互不等待
+            entry = self._battle_locks.setdefault(battle_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await loop.run_in_executor(threads, self._run_wsgi, environ, send, loop)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._battle_locks[battle_id]
+        finally:
+            self._pending_requests -= 1
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0] if client else '',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ, send, loop):
+        """Calls the WSGI app in this worker thread and forwards its response to the loop.
+
+        Each chunk waits until the server has taken it, so streaming routes
+        (/battle/stream, /api/jobs/<id>/stream) are paced by the client.
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+            }
+
+        def forward(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    forward(response['start'])
+                    started = True
+                forward({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                forward(response['start'])
+            forward({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+
+app = AsgiApp(flask_app)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Fight Card through uvicorn (ASGI)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+    if uvicorn is None:
+        print("Error: uvicorn is not installed (pip install uvicorn); any other ASGI server can serve asgi:app.")
+        return
+    # 只用一个服务进程：对战状态和后台任务保存在进程内存中
+    uvicorn.run(app, host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
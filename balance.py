@@ -0,0 +1,228 @@
+"""Balance search: proposes numeric changes that bring win rates into a target band.
+
+Every character gets one multiplier per tuned field group (``hp``, skill
+``damage``, ``resistance``). Each iteration nudges the multipliers of the
+characters whose round-robin win rate is outside ``[low, high]`` (down if
+they win too often, up if too rarely), re-runs the round robin and keeps
+the step if the total distance to the band shrank; otherwise the step size
+is halved. No gradients are needed, only win rates.
+
+Evaluations use common random numbers: every pairing is always simulated
+with the same seed (tournament.pairing_seed), so two candidates are compared
+on identical random draws and the difference between them is the effect of
+the change, not sampling noise. Pairings are spread over a process pool
+that lives for the whole search, and results are cached by character
+content (matchup_cache.py), so a step only re-simulates the pairings of the
+characters it changed.
+
+The result is a unified diff of characters.json; nothing is written back.
+Usage: python balance.py --low 0.45 --high 0.55 --fields hp,damage
+"""
+import argparse
+import copy
+import difflib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import lockstep
+from matchup_cache import MatchupCache
+from tournament import ENGINES, merge_results, pairing_seed, pairings
+
+FIELDS = ('hp', 'damage', 'resistance')
+
+def apply_multipliers(char, multipliers):
+    """Returns a copy of ``char`` with its tuned fields scaled and rounded to integers."""
+    char = copy.deepcopy(char)
+    if 'hp' in multipliers:
+        char['stats']['hp'] = max(1, round(char['stats']['hp'] * multipliers['hp']))
+    if 'damage' in multipliers:
+        for skill in char.get('skills') or []:
+            damage = skill.get('damage') if isinstance(skill, dict) else None
+            for element, value in (damage or {}).items():
+                if isinstance(value, (int, float)) and value:
+                    damage[element] = max(0, round(value * multipliers['damage']))
+    if 'resistance' in multipliers:
+        for attr in char.get('attributes') or []:
+            resistance = attr.get('resistance') if isinstance(attr, dict) else None
+            for element, value in (resistance or {}).items():
+                if isinstance(value, (int, float)) and value:
+                    resistance[element] = round(value * multipliers['resistance'])
+    return char
+
+def _seed_for(seed, team1, team2):
+    return pairing_seed(seed, [c['id'] for c in team1], [c['id'] for c in team2])
+
+def _run_pairings(chunk, battles, seed, engine):
+    simulate_matchup = ENGINES[engine]
+    return [simulate_matchup(team1, team2, battles, seed=_seed_for(seed, team1, team2)) for team1, team2 in chunk]
+
+class BalanceSearch:
+    """Pattern search over per-character field multipliers (see module docstring)."""
+
+    def __init__(self, characters, low=0.45, high=0.55, fields=('hp',), mode='1v1',
+                 battles=2000, seed=0, engine=None, workers=None, step=0.2, min_step=0.01, cache=None):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown balance fields: {', '.join(sorted(unknown))}")
+        if engine is None:
+            engine = 'lockstep' if lockstep.available() else 'python'
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown simulation engine: {engine}")
+        self.characters = [c for c in characters if isinstance(c, dict) and 'id' in c]
+        self.low = low
+        self.high = high
+        self.fields = tuple(fields)
+        self.mode = mode
+        self.battles = battles
+        self.seed = seed
+        self.engine = engine
+        self.workers = workers
+        self.step = step
+        self.min_step = min_step
+        self.pairings = list(pairings([c['id'] for c in self.characters], mode))
+        self.cache = cache if cache is not None else MatchupCache(directory=None)
+
+    def candidate(self, multipliers):
+        return [apply_multipliers(c, multipliers[c['id']]) for c in self.characters]
+
+    def win_rates(self, roster, executor=None):
+        """Round-robin win rate (wins / battles) of every character in ``roster``."""
+        by_id = {c['id']: c for c in roster}
+        stats = {}
+        tasks = []
+        for t1, t2 in self.pairings:
+            team1, team2 = [by_id[i] for i in t1], [by_id[i] for i in t2]
+            cached = self.cache.get(team1, team2, self.battles, _seed_for(self.seed, team1, team2), self.engine)
+            if cached is not None:
+                stats[t1, t2] = cached
+            else:
+                tasks.append((team1, team2))
+        # 每个进程约四块以平衡负载；按提交顺序取回结果，与进程数无关
+        chunk_size = max(1, -(-len(tasks) // (4 * (self.workers or os.cpu_count() or 1))))
+        chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+        args = (itertools.repeat(self.battles), itertools.repeat(self.seed), itertools.repeat(self.engine))
+        computed = map(_run_pairings, chunks, *args) if executor is None else executor.map(_run_pairings, chunks, *args)
+        for chunk, chunk_results in zip(chunks, computed):
+            for (team1, team2), result in zip(chunk, chunk_results):
+                key = (tuple(c['id'] for c in team1), tuple(c['id'] for c in team2))
+                stats[key] = self.cache.put(
+                    team1, team2, self.battles, _seed_for(self.seed, team1, team2), self.engine, result)
+        results = [
+            {"team1": list(t1), "team2": list(t2), "wins": stats[t1, t2]["wins"],
+             "losses": stats[t1, t2]["losses"], "draws": stats[t1, t2]["draws"]}
+            for t1, t2 in self.pairings
+        ]
+        _, standings = merge_results(results)
+        return {char_id: r["wins"] / r["battles"] if r["battles"] else 0 for char_id, r in standings.items()}
+
+    def distance(self, rates):
+        """Sum of squared distances of the win rates to the target band."""
+        total = 0.0
+        for rate in rates.values():
+            if rate < self.low:
+                total += (self.low - rate) ** 2
+            elif rate > self.high:
+                total += (rate - self.high) ** 2
+        return total
+
+    def run(self, iterations=30, progress=None):
+        """Runs the search and returns (proposed roster, initial win rates, final win rates)."""
+        multipliers = {c['id']: {field: 1.0 for field in self.fields} for c in self.characters}
+        executor = None if self.workers == 1 else ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            initial = rates = self.win_rates(self.characters, executor)
+            distance = self.distance(rates)
+            step = self.step
+            for iteration in range(iterations):
+                if distance == 0 or step < self.min_step:
+                    break
+                trial = copy.deepcopy(multipliers)
+                for char_id, rate in rates.items():
+                    if rate > self.high:
+                        direction = -1 # 太强：降低生命/伤害/抗性
+                    elif rate < self.low:
+                        direction = 1
+                    else:
+                        continue
+                    for field in self.fields:
+                        trial[char_id][field] *= 1 + direction * step
+                trial_rates = self.win_rates(self.candidate(trial), executor)
+                trial_distance = self.distance(trial_rates)
+                accepted = trial_distance < distance
+                if accepted:
+                    multipliers, rates, distance = trial, trial_rates, trial_distance
+                else:
+                    step /= 2
+                if progress is not None:
+                    progress(iteration, distance, step, accepted)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.candidate(multipliers), initial, rates
+
+def _hunk_range(start, length):
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+def roster_diff(before, after, path='data/characters.json', context=3):
+    """Unified diff between two rosters as characters.json would store them."""
+    def lines(characters):
+        return json.dumps({'characters': characters}, indent=2, ensure_ascii=False).splitlines(keepends=True)
+    a, b = lines(before), lines(after)
+    # 关闭 autojunk：'"水": 0,' 这类行大量重复，默认会被当作噪声导致差异错位
+    groups = list(difflib.SequenceMatcher(None, a, b, autojunk=False).get_grouped_opcodes(context))
+    if not groups:
+        return ''
+    out = [f"--- a/{path}\n", f"+++ b/{path}\n"]
+    for group in groups:
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        out.append(f"@@ -{_hunk_range(i1, i2 - i1)} +{_hunk_range(j1, j2 - j1)} @@\n")
+        for tag, a1, a2, b1, b2 in group:
+            if tag == 'equal':
+                out.extend(' ' + line for line in a[a1:a2])
+                continue
+            out.extend('-' + line for line in a[a1:a2])
+            out.extend('+' + line for line in b[b1:b2])
+    return ''.join(out)
+
+def main(argv=None):
+    from repository import DATA_FILE, repository
+
+    parser = argparse.ArgumentParser(description="Propose characters.json changes that bring win rates into a target band")
+    parser.add_argument('--low', type=float, default=0.45, help="lowest acceptable win rate")
+    parser.add_argument('--high', type=float, default=0.55, help="highest acceptable win rate")
+    parser.add_argument('--fields', default='hp', help=f"comma-separated fields to tune ({', '.join(FIELDS)})")
+    parser.add_argument('--mode', choices=['1v1', '2v2'], default='1v1')
+    parser.add_argument('--battles', type=int, default=2000, help="battles per pairing and evaluation")
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--seed', default='0', help="seed shared by every evaluation (common random numbers)")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=None,
+                        help="batch simulator (default: lockstep if NumPy is installed)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=None, help="write the diff here instead of stdout")
+    args = parser.parse_args(argv)
+
+    characters = repository.all()
+    search = BalanceSearch(
+        characters, args.low, args.high, [f.strip() for f in args.fields.split(',') if f.strip()],
+        args.mode, args.battles, args.seed, args.engine, args.workers)
+    proposed, initial, final = search.run(
+        args.iterations,
+        progress=lambda i, distance, step, accepted: print(f"第 {i + 1} 轮: 距离 {distance:.5f} 步长 {step:.4f} {'接受' if accepted else '拒绝'}"))
+
+    names = {c['id']: c['name'] for c in characters}
+    for char_id in sorted(final):
+        print(f"{names.get(char_id, char_id)}: {initial.get(char_id, 0):.1%} -> {final[char_id]:.1%}")
+    diff = roster_diff(characters, proposed, DATA_FILE)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(diff)
+        print(f"已写入 {args.output}")
+    else:
+        print(diff)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,44 @@
+import hashlib
 import json
 import random
-import os
+import re
+from damage import base_damage
+from fighter import FLUCTUATION, MAX_TURNS, create_fighters
+from step_codec import format_message
+from repository import DATA_FILE, DATABASE_FILE, STORAGE_BACKEND, create_store
+from win_rate_ledger import WinRateLedger
 
 WIN_RATES_FILE = 'data/win_rates.json'
 
-def load_characters(filepath="data/characters.json"):
-    """Loads character data from a JSON file."""
+# 对战引擎版本：随机数的使用顺序改变时递增，旧版本的回放记录将无法重现
+ENGINE_VERSION = 3
+
+# 伤害波动范围 ±15%，按 random.uniform 的方式计算以保持随机数序列不变
+FLUCTUATION_LOW = -FLUCTUATION
+FLUCTUATION_SPAN = FLUCTUATION - FLUCTUATION_LOW
+
+MAX_TEAM_SIZE = 100 # NvM 模式每队最多角色数
+
+# 影响对战过程和日志的角色字段，回放快照和 roster_hash 只包含这些字段
+SNAPSHOT_KEYS = ('id', 'name', 'stats', 'skills', 'attributes', 'image', 'audio', 'element')
+
+def _create_win_rate_store():
+    """Returns the win-rate store selected by FIGHT_CARD_STORAGE."""
+    if STORAGE_BACKEND == 'sqlite':
+        from sqlite_store import SqliteWinRateStore
+        return SqliteWinRateStore(DATABASE_FILE)
+    return WinRateLedger(WIN_RATES_FILE)
+
+win_rate_store = _create_win_rate_store()
+_character_store = None # SQLite 后端的角色存储，首次使用时创建后复用（连接按线程缓存）
+
+def load_characters(filepath=DATA_FILE):
+    """Loads character data from a JSON file (or the SQLite store when enabled)."""
+    global _character_store
+    if STORAGE_BACKEND == 'sqlite' and filepath == DATA_FILE:
+        if _character_store is None:
+            _character_store = create_store()
+        return _character_store.load()
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -18,34 +51,57 @@ def load_characters(filepath="data/characters.json"):
         return []
 
 def load_win_rates():
-    """Loads win rates data from a JSON file."""
-    if not os.path.exists(WIN_RATES_FILE):
-        return {}
-    try:
-        with open(WIN_RATES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {WIN_RATES_FILE}")
-        return {}
+    """Returns the current win rates from the configured win-rate store."""
+    return win_rate_store.load()
 
 def save_win_rates(win_rates):
-    """Saves win rates data to a JSON file."""
-    with open(WIN_RATES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(win_rates, f, indent=2)
-
-def select_characters(characters, team1_ids=None, team2_ids=None, battle_mode='2v2'):
-    """Selects characters for battle, either by ID or randomly, based on battle_mode."""
+    """Overwrites all win rates. Battles should use record_battle_result instead."""
+    win_rate_store.replace(win_rates)
+
+def record_battle_result(winner_ids=(), loser_ids=()):
+    """Records one finished battle; draws pass every participant as a loser."""
+    win_rate_store.record(winner_ids, loser_ids)
+
+def team_sizes(battle_mode):
+    """Returns (team1 size, team2 size) for an "NvM" mode such as '1v1', '5v5' or '1v20'.
+
+    Returns None for anything else (including 'free_for_all').
+    """
+    match = re.fullmatch(r'(\d+)v(\d+)', battle_mode or '')
+    if not match:
+        return None
+    sizes = int(match.group(1)), int(match.group(2))
+    if not all(1 <= size <= MAX_TEAM_SIZE for size in sizes):
+        return None
+    return sizes
+
+def select_characters(characters, team1_ids=None, team2_ids=None, battle_mode='2v2', index=None):
+    """Selects characters for battle, either by ID or randomly, based on battle_mode.
+
+    ``battle_mode`` is any team_sizes mode ('1v1', '2v2', '5v5', '1v20', ...).
+    ``index`` is an optional id→character mapping (e.g. the repository's
+    CharacterIndex); without one a dict is built once per call instead of
+    scanning the roster for every id. The returned teams reference the
+    roster's own dicts: battles keep their state in fighter.FighterState and
+    never modify them.
+    """
     if not characters:
         return [], []
 
-    num_chars_per_team = 1 if battle_mode == '1v1' else 2
-    required_total_chars = num_chars_per_team * 2
+    sizes = team_sizes(battle_mode)
+    if sizes is None:
+        print(f"Error: Unsupported battle mode {battle_mode}.")
+        return [], []
+    team1_size, team2_size = sizes
+    required_total_chars = team1_size + team2_size
 
     if team1_ids is not None and team2_ids is not None:
-        team1 = [next((c for c in characters if c["id"] == char_id), None) for char_id in team1_ids]
-        team2 = [next((c for c in characters if c["id"] == char_id), None) for char_id in team2_ids]
+        if index is None:
+            index = {c["id"]: c for c in characters}
+        team1 = [index.get(char_id) for char_id in team1_ids]
+        team2 = [index.get(char_id) for char_id in team2_ids]
         
-        if len(team1) != num_chars_per_team or len(team2) != num_chars_per_team or \
+        if len(team1) != team1_size or len(team2) != team2_size or \
            any(c is None for c in team1) or any(c is None for c in team2):
             print(f"Error: Specified character ID(s) not found or incorrect number of characters for {battle_mode} battle.")
             return [], []
@@ -54,408 +110,429 @@ def select_characters(characters, team1_ids=None, team2_ids=None, battle_mode='2
             print(f"Error: Not enough characters for a random {battle_mode} battle.")
             return [], []
         selected_chars = random.sample(characters, required_total_chars)
-        team1 = selected_chars[:num_chars_per_team]
-        team2 = selected_chars[num_chars_per_team:]
+        team1 = selected_chars[:team1_size]
+        team2 = selected_chars[team1_size:]
 
     return team1, team2
 
-def simulate_battle(team1, team2, battle_mode='2v2'):
-    """Simulates a turn-based battle between two teams and returns detailed steps."""
-    num_chars_per_team = 1 if battle_mode == '1v1' else 2
-    if not team1 or not team2 or len(team1) != num_chars_per_team or len(team2) != num_chars_per_team:
+def new_battle_seed():
+    """Returns a fresh seed for one battle."""
+    return random.getrandbits(63)
+
+def roster_snapshot(characters):
+    """Returns copies of the battle-relevant fields of ``characters``, in order."""
+    return [{key: value for key, value in char.items() if key in SNAPSHOT_KEYS} for char in characters]
+
+def roster_hash(characters):
+    """Content hash of the participants' battle-relevant fields."""
+    canonical = json.dumps(roster_snapshot(characters), ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def battle_record(battle_mode, seed, team1, team2=None):
+    """The few fields replay_battle needs to regenerate a battle's full step list."""
+    participants = team1 + (team2 or [])
+    record = {
+        "engine_version": ENGINE_VERSION,
+        "mode": battle_mode,
+        "seed": seed,
+        "roster_hash": roster_hash(participants),
+    }
+    if battle_mode == 'free_for_all':
+        record["ids"] = [c['id'] for c in team1]
+    else:
+        record["team1_ids"] = [c['id'] for c in team1]
+        record["team2_ids"] = [c['id'] for c in team2]
+    return record
+
+def replay_battle(record, characters):
+    """Re-runs a battle from ``battle_record`` output and returns (steps, result).
+
+    ``characters`` must contain the participants exactly as they were when the
+    battle was fought (e.g. a stored roster snapshot); a ValueError is raised
+    when the engine version or the roster hash does not match. Win rates are
+    not touched.
+    """
+    if record.get("engine_version") != ENGINE_VERSION:
+        raise ValueError(f"Replay was recorded with engine version {record.get('engine_version')}, current is {ENGINE_VERSION}.")
+    index = {c["id"]: c for c in characters}
+    mode = record["mode"]
+    if mode == 'free_for_all':
+        team1 = [index.get(char_id) for char_id in record["ids"]]
+        team2 = []
+    else:
+        team1 = [index.get(char_id) for char_id in record["team1_ids"]]
+        team2 = [index.get(char_id) for char_id in record["team2_ids"]]
+    if any(c is None for c in team1 + team2):
+        raise ValueError("Replay roster is missing participants.")
+    team1 = roster_snapshot(team1)
+    team2 = roster_snapshot(team2)
+    if roster_hash(team1 + team2) != record["roster_hash"]:
+        raise ValueError("Replay roster does not match the recorded roster hash.")
+    if mode == 'free_for_all':
+        return simulate_battle_free_for_all(team1, seed=record["seed"], record_result=False)
+    return simulate_battle(team1, team2, battle_mode=mode, seed=record["seed"], record_result=False)
+
+def simulate_battle(team1, team2, battle_mode='2v2', seed=None, record_result=True):
+    """Simulates a turn-based battle between two teams and returns detailed steps.
+
+    All randomness comes from ``random.Random(seed)``, so the same seed and
+    teams always produce the same steps (see replay_battle). Pass
+    ``record_result=False`` to leave win rates untouched.
+    """
+    if not valid_teams(team1, team2, battle_mode):
         return [], "Battle could not start due to invalid teams or incorrect number of characters for the selected mode."
+    return collect_steps(iter_battle(team1, team2, battle_mode, seed, record_result))
 
-    battle_steps = []
-    
-    # Initialize current HP and battle stats for all characters
-    for char in team1 + team2:
-        char['current_hp'] = char['stats']['hp']
-        char['damage_dealt'] = 0
-        char['damage_taken'] = 0
-        char['healing_done'] = 0 # Placeholder for future healing mechanics
-
-    team1_names = ", ".join([c['name'] for c in team1])
-    team2_names = ", ".join([c['name'] for c in team2])
-    
-    if battle_mode == '1v1':
-        battle_steps.append({"event": "start", "message": f"1V1 战斗开始: 「{team1_names}」 vs 「{team2_names}」"})
+def valid_teams(team1, team2, battle_mode='2v2'):
+    sizes = team_sizes(battle_mode)
+    return sizes is not None and bool(team1) and bool(team2) and (len(team1), len(team2)) == sizes
+
+def iter_battle(team1, team2, battle_mode='2v2', seed=None, record_result=True, log=True):
+    """Generator form of simulate_battle: yields each step as soon as it is computed.
+
+    The last step is the "end" event carrying the result. Callers must check
+    the teams with valid_teams first. See battle_events for ``log``.
+    """
+    return battle_events([team1, team2], battle_mode, seed, record_result, log)
+
+def simulate_battle_free_for_all(all_characters, seed=None, record_result=True):
+    """Simulates a free-for-all battle among all characters.
+
+    ``seed`` and ``record_result`` behave as in simulate_battle.
+    """
+    if len(all_characters) < 2:
+        return [], "大乱斗模式至少需要两个角色。"
+    return collect_steps(iter_battle_free_for_all(all_characters, seed, record_result))
+
+def simulate_battle_by_mode(battle_mode, team1, team2=None, seed=None, record_result=True):
+    """simulate_battle, or simulate_battle_free_for_all over ``team1`` for free_for_all.
+
+    Module-level so it can run in a worker process: asgi.py passes
+    ``record_result=False`` and records the end step's ``winners`` itself.
+    """
+    if battle_mode == 'free_for_all':
+        return simulate_battle_free_for_all(team1, seed=seed, record_result=record_result)
+    return simulate_battle(team1, team2, battle_mode=battle_mode, seed=seed, record_result=record_result)
+
+def iter_battle_free_for_all(all_characters, seed=None, record_result=True, log=True):
+    """Generator form of simulate_battle_free_for_all (at least two characters)."""
+    return battle_events([[c] for c in all_characters], 'free_for_all', seed, record_result, log)
+
+def battle_events(teams, battle_mode, seed=None, record_result=True, log=True):
+    """The battle loop shared by every mode; yields step dicts.
+
+    ``teams`` is a list of teams of character dicts (free-for-all: one team
+    per character). The dicts are only read: all battle state lives in
+    per-battle FighterState objects, so shared/cached rosters need no copies.
+    Per-turn steps are yielded without ``message``; sinks that need the text
+    add it with step_codec.format_message (collect_steps, stream_chunks do).
+    With ``log=False`` only the final "end" step is produced, so outcome-only
+    callers build no per-turn step dicts at all. The end step also carries
+    ``winners`` (character ids, empty on a draw) and ``turns``.
+    Per-turn steps name their characters and also carry ``position`` (the
+    step's ``character``/``attacker``) and ``defender_position``: indexes
+    into the participants in team order, which stay unambiguous when two
+    fighters share a name.
+    """
+    if seed is None:
+        seed = new_battle_seed()
+    rng = random.Random(seed)
+    rand = rng.random
+    randrange = rng.randrange
+    choice = rng.choice
+    shuffle = rng.shuffle
+    free_for_all = battle_mode == 'free_for_all'
+    teams = create_fighters(teams)
+    fighters = [f for team in teams for f in team]
+
+    if log:
+        yield _start_step(teams, battle_mode, seed)
+
+    # 大乱斗用存活集合选择对手和判断结束，每次攻击 O(1)，不再逐个扫描所有角色；
+    # 组队模式每队一个按队伍顺序排列的存活列表，对手选择与原先的 1v1/2v2 完全一致
+    if free_for_all:
+        alive = _AliveSet(f for f in fighters if f.current_hp > 0)
     else:
-        battle_steps.append({"event": "start", "message": f"2V2 战斗开始: 队伍1 ({team1_names}) vs 队伍2 ({team2_names})"})
- 
-    MAX_TURNS = 200 # 设置最大回合数以防止无限战斗或内存错误
-    turn = 1
-    while any(c['current_hp'] > 0 for c in team1) and any(c['current_hp'] > 0 for c in team2) and turn <= MAX_TURNS:
-        battle_steps.append({"event": "turn_start", "turn": turn, "message": f"--- 第 {turn} 回合 ---"})
+        pools = [[f for f in team if f.current_hp > 0] for team in teams]
+
+    turn = 0
+    finished = _alive_team_count(teams) <= 1
+    while not finished and turn < MAX_TURNS:
+        turn += 1
+        if log:
+            yield {"event": "turn_start", "turn": turn}
 
         # 组合所有活跃的战斗者并随机化行动顺序
-        active_fighters = [c for c in team1 + team2 if c['current_hp'] > 0]
-        random.shuffle(active_fighters)
+        if free_for_all:
+            active_fighters = list(alive.items)
+        else:
+            active_fighters = [f for f in fighters if f.current_hp > 0]
+        shuffle(active_fighters)
 
         for attacker in active_fighters:
-            if attacker['current_hp'] <= 0:
-                battle_steps.append({"event": "skip_turn", "character": attacker['name'], "message": f"「{attacker['name']}」已被击败，跳过回合。"})
+            if attacker.current_hp <= 0:
+                if log:
+                    yield {"event": "skip_turn", "character": attacker.name, "position": attacker.position}
                 continue # 如果角色已被击败，则跳过回合
 
-            battle_steps.append({"event": "character_turn", "character": attacker['name'], "message": f"「{attacker['name']}」的回合。"})
+            if log:
+                yield {"event": "character_turn", "character": attacker.name, "position": attacker.position}
 
-            # Determine opponent team
-            opponent_team = team2 if attacker in team1 else team1
-            
-            # Select active opponents
-            active_opponents = [c for c in opponent_team if c['current_hp'] > 0]
-
-            if not active_opponents:
-                # Opponent team is defeated, battle ends
-                break
+            if free_for_all:
+                if len(alive) < 2:
+                    break
+            else:
+                active_opponents = pools[1 - attacker.team]
+                if not active_opponents:
+                    break
 
             # Randomly select a skill
-            if not attacker['skills']:
-                battle_steps.append({"event": "no_skill", "character": attacker['name'], "message": f"「{attacker['name']}」没有技能，跳过回合。"})
+            skill_items = attacker.skill_items
+            if not skill_items:
+                if log:
+                    yield {"event": "no_skill", "character": attacker.name, "position": attacker.position}
                 continue
-            skill = random.choice(attacker['skills'])
-            
+            skill_index = randrange(len(skill_items))
+
             # 随机选择一个活跃的对手作为防御者
-            defender = random.choice(active_opponents)
-
-            battle_steps.append({
-                "event": "use_skill",
-                "character": attacker['name'],
-                "defender": defender['name'],
-                "skill": skill['name'],
-                "effect": skill['effect'],
-                "audio": skill.get('audio', '').replace('assets/', 'audio/'),
-                "message": f"「{attacker['name']}」对「{defender['name']}」使用了「{skill['name']}」！"
-            })
-            print(f"DEBUG: Skill audio (original): {skill.get('audio', '')}")
-            print(f"DEBUG: Skill audio (processed): {skill.get('audio', '').replace('assets/', 'audio/')}")
-
-            # 初始化总伤害
-            total_damage = 0
-            
-            # 遍历技能的每种伤害类型
-            for damage_type, base_damage in skill['damage'].items():
-                # 获取防御者对应类型的抗性
-                # 假设每个角色只有一个属性，且属性中包含resistance
-                defender_resistance = 0
-                if 'attributes' in defender and defender['attributes']:
-                    for attr in defender['attributes']:
-                        if 'resistance' in attr and damage_type in attr['resistance']:
-                            defender_resistance = attr['resistance'][damage_type]
-                            break # 找到抗性后跳出循环
-                
-                # 计算实际伤害：基础伤害减去抗性，确保不低于0
-                # 这里可以根据需求调整抗性计算方式，例如百分比减免
-                actual_damage_for_type = max(0, base_damage - defender_resistance)
-                total_damage += actual_damage_for_type
-                
-            # 应用伤害波动
-            fluctuation_percentage = random.uniform(-0.15, 0.15)
-            damage_dealt = total_damage * (1 + fluctuation_percentage)
+            if free_for_all:
+                defender = alive.sample_other(rng, attacker)
+            else:
+                defender = choice(active_opponents)
+
+            if log:
+                skill = attacker.character.skills[skill_index]
+                audio = skill.get('audio', '')
+                yield {
+                    "event": "use_skill",
+                    "character": attacker.name,
+                    "defender": defender.name,
+                    "position": attacker.position,
+                    "defender_position": defender.position,
+                    "skill": skill['name'],
+                    "effect": skill['effect'],
+                    "audio": audio if free_for_all else audio.replace('assets/', 'audio/'),
+                }
+
+            # 基础伤害 = Σ max(0, 技能伤害 - 抗性)，技能表在角色编译时已准备好
+            total_damage = base_damage(skill_items[skill_index], defender.resistances)
+
+            # 应用伤害波动（与 rng.uniform(-FLUCTUATION, FLUCTUATION) 相同的计算）
+            damage_dealt = total_damage * (1 + (FLUCTUATION_LOW + FLUCTUATION_SPAN * rand()))
             damage_dealt = max(0, round(damage_dealt))
 
-            defender_hp_before = defender['current_hp']
-            defender['current_hp'] -= damage_dealt
-            defender_hp_after = max(0, defender['current_hp'])
+            defender_hp_before = defender.current_hp
+            defender.current_hp -= damage_dealt
 
             # 更新统计数据
-            attacker['damage_dealt'] += damage_dealt
-            defender['damage_taken'] += damage_dealt
-
-            battle_steps.append({
-                "event": "deal_damage",
-                "attacker": attacker['name'],
-                "defender": defender['name'],
-                "skill": skill['name'],
-                "damage_dealt": damage_dealt,
-                "defender_hp_before": defender_hp_before,
-                "defender_hp_after": defender_hp_after,
-                "message": f"「{defender['name']}」受到了 {damage_dealt} 点伤害。"
-            })
-            battle_steps.append({"event": "hp_update", "character": defender['name'], "hp": defender_hp_after, "message": f"「{defender['name']}」剩余生命值: {defender_hp_after:.2f}"})
-
-            if defender['current_hp'] <= 0:
-                battle_steps.append({"event": "defeated", "character": defender['name'], "message": f"「{defender['name']}」已被击败！"})
-                # 检查整个队伍是否被击败
-                if not any(c['current_hp'] > 0 for c in opponent_team):
-                    # 一队被完全击败，立即结束战斗
-                    winner_team_chars = team1 if opponent_team is team2 else team2
-                    
-                    # 计算MVP
-                    mvp_char = None
-                    max_damage = -1
-                    for char in winner_team_chars:
-                        if char['damage_dealt'] > max_damage:
-                            max_damage = char['damage_dealt']
-                            mvp_char = char
-                    
-                    final_result_message = ""
-                    if mvp_char:
-                        if battle_mode == '1v1':
-                            final_result_message = f"恭喜「{mvp_char['name']}」获得了胜利！"
-                        else:
-                            other_winner_char = next((c for c in winner_team_chars if c is not mvp_char), None)
-                            if other_winner_char:
-                                final_result_message = f"恭喜「{mvp_char['name']}」获得了MVP，「{other_winner_char['name']}」是躺赢狗！"
-                            else:
-                                final_result_message = f"恭喜队伍 {'1' if opponent_team is team2 else '2'} 获得了胜利！"
-                    else:
-                        final_result_message = f"恭喜队伍 {'1' if opponent_team is team2 else '2'} 获得了胜利！"
-
-                    # 收集所有角色的最终统计数据
-                    character_stats = []
-                    for char in team1 + team2:
-                        character_stats.append({
-                            "name": char['name'],
-                            "team": "队伍1" if char in team1 else "队伍2",
-                            "damage_dealt": char['damage_dealt'],
-                            "damage_taken": char['damage_taken'],
-                            "healing_done": char['healing_done']
-                        })
-                    
-                    battle_steps.append({"event": "end", "result": final_result_message, "character_stats": character_stats, "message": final_result_message})
-                    
-                    # Update win rates
-                    win_rates = load_win_rates()
-                    winning_team_ids = [c['id'] for c in winner_team_chars]
-                    losing_team_ids = [c['id'] for c in (team2 if opponent_team is team2 else team1)]
-
-                    for char_id in winning_team_ids:
-                        win_rates.setdefault(str(char_id), {"total_battles": 0, "wins": 0})
-                        win_rates[str(char_id)]["total_battles"] += 1
-                        win_rates[str(char_id)]["wins"] += 1
-                    for char_id in losing_team_ids:
-                        win_rates.setdefault(str(char_id), {"total_battles": 0, "wins": 0})
-                        win_rates[str(char_id)]["total_battles"] += 1
-                    save_win_rates(win_rates)
-
-                    return battle_steps, final_result_message
-
-        turn += 1
-        # 检查所有活跃的战斗者行动结束后战斗是否应该结束
-        if not any(c['current_hp'] > 0 for c in team1) or not any(c['current_hp'] > 0 for c in team2):
-            break
-
-    # 达到最大回合数或双方都阵亡
-    final_result_message = ""
-    team1_alive = any(c['current_hp'] > 0 for c in team1)
-    team2_alive = any(c['current_hp'] > 0 for c in team2)
-
-    if team1_alive and team2_alive:
-        final_result_message = "战斗结束: 平局！(达到最大回合数)"
-    elif team1_alive:
-        # 计算MVP
-        mvp_char = None
-        max_damage = -1
-        for char in team1:
-            if char['damage_dealt'] > max_damage:
-                max_damage = char['damage_dealt']
-                mvp_char = char
-        
-        if mvp_char:
-            if battle_mode == '1v1':
-                final_result_message = f"恭喜「{mvp_char['name']}」获得了胜利！"
-            else:
-                other_winner_char = next((c for c in team1 if c is not mvp_char), None)
-                if other_winner_char:
-                    final_result_message = f"恭喜「{mvp_char['name']}」获得了MVP，「{other_winner_char['name']}」是躺赢狗！"
-                else:
-                    final_result_message = "恭喜队伍1获得了胜利！"
-        else:
-            final_result_message = "恭喜队伍1获得了胜利！"
-
-    elif team2_alive:
-        # 计算MVP
-        mvp_char = None
-        max_damage = -1
-        for char in team2:
-            if char['damage_dealt'] > max_damage:
-                max_damage = char['damage_dealt']
-                mvp_char = char
-        
-        if mvp_char:
-            if battle_mode == '1v1':
-                final_result_message = f"恭喜「{mvp_char['name']}」获得了胜利！"
-            else:
-                other_winner_char = next((c for c in team2 if c is not mvp_char), None)
-                if other_winner_char:
-                    final_result_message = f"恭喜「{mvp_char['name']}」获得了MVP，「{other_winner_char['name']}」是躺赢狗！"
+            attacker.damage_dealt += damage_dealt
+            defender.damage_taken += damage_dealt
+
+            if log:
+                defender_hp_after = max(0, defender.current_hp)
+                yield {
+                    "event": "deal_damage",
+                    "attacker": attacker.name,
+                    "defender": defender.name,
+                    "position": attacker.position,
+                    "defender_position": defender.position,
+                    "skill": attacker.character.skills[skill_index]['name'],
+                    "damage_dealt": damage_dealt,
+                    "defender_hp_before": defender_hp_before,
+                    "defender_hp_after": defender_hp_after,
+                }
+                yield {"event": "hp_update", "character": defender.name, "hp": defender_hp_after, "position": defender.position}
+
+            if defender.current_hp <= 0:
+                if log:
+                    yield {"event": "defeated", "character": defender.name, "position": defender.position}
+                # 只剩一支队伍时立即结束战斗
+                if free_for_all:
+                    alive.remove(defender)
+                    finished = len(alive) <= 1
                 else:
-                    final_result_message = "恭喜队伍2获得了胜利！"
-        else:
-            final_result_message = "恭喜队伍2获得了胜利！"
-    else:
-        final_result_message = "战斗结束: 平局！(双方队伍都被击败)"
+                    pool = pools[defender.team]
+                    del pool[next(i for i, f in enumerate(pool) if f is defender)]
+                    finished = not pool
+                if finished:
+                    break
+
+    alive_teams = [i for i, team in enumerate(teams) if any(f.current_hp > 0 for f in team)]
+    winner_team = alive_teams[0] if len(alive_teams) == 1 else None
+    winners = teams[winner_team] if winner_team is not None else []
+    losers = [f for f in fighters if f.team != winner_team]
+    final_result_message = _result_message(teams, battle_mode, winners)
+
+    # 在产出 end 之前记录胜率，流式调用方读到 end 即可停止；平局时所有角色都记为失败
+    if record_result:
+        record_battle_result([f.character.id for f in winners], [f.character.id for f in losers])
 
     # 收集所有角色的最终统计数据
     character_stats = []
-    for char in team1 + team2:
-        character_stats.append({
-            "name": char['name'],
-            "team": "队伍1" if char in team1 else "队伍2",
-            "damage_dealt": char['damage_dealt'],
-            "damage_taken": char['damage_taken'],
-            "healing_done": char['healing_done']
-        })
-    
-    battle_steps.append({"event": "end", "result": final_result_message, "character_stats": character_stats, "message": final_result_message})
-    
-    # Update win rates for draw/max turns
-    win_rates = load_win_rates()
-    for char in team1 + team2:
-        win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-        win_rates[str(char['id'])]["total_battles"] += 1
-    save_win_rates(win_rates)
-
-    return battle_steps, final_result_message
-
-def simulate_battle_free_for_all(all_characters):
-    """Simulates a free-for-all battle among all characters."""
-    battle_steps = []
-    
-    if len(all_characters) < 2:
-        return [], "大乱斗模式至少需要两个角色。"
-
-    # Initialize current HP and battle stats for all characters
-    for char in all_characters:
-        char['current_hp'] = char['stats']['hp']
-        char['damage_dealt'] = 0
-        char['damage_taken'] = 0
-        char['healing_done'] = 0
-
-    character_names = ", ".join([c['name'] for c in all_characters])
-    battle_steps.append({"event": "start", "message": f"大乱斗开始！参战角色: {character_names}", "characters": all_characters})
-
-    MAX_TURNS = 200
-    turn = 1
-    while len([c for c in all_characters if c['current_hp'] > 0]) > 1 and turn <= MAX_TURNS:
-        battle_steps.append({"event": "turn_start", "turn": turn, "message": f"--- 第 {turn} 回合 ---"})
-
-        active_fighters = [c for c in all_characters if c['current_hp'] > 0]
-        random.shuffle(active_fighters)
-
-        for attacker in active_fighters:
-            if attacker['current_hp'] <= 0:
-                battle_steps.append({"event": "skip_turn", "character": attacker['name'], "message": f"「{attacker['name']}」已被击败，跳过回合。"})
-                continue
-
-            battle_steps.append({"event": "character_turn", "character": attacker['name'], "message": f"「{attacker['name']}」的回合。"})
-
-            # Select active opponents (anyone not the attacker and still alive)
-            active_opponents = [c for c in active_fighters if c is not attacker and c['current_hp'] > 0]
-
-            if not active_opponents:
-                # Only one character left, battle ends
-                break
-
-            if not attacker['skills']:
-                battle_steps.append({"event": "no_skill", "character": attacker['name'], "message": f"「{attacker['name']}」没有技能，跳过回合。"})
-                continue
-            skill = random.choice(attacker['skills'])
-            
-            defender = random.choice(active_opponents)
-
-            battle_steps.append({
-                "event": "use_skill",
-                "character": attacker['name'],
-                "defender": defender['name'],
-                "skill": skill['name'],
-                "effect": skill['effect'],
-                "audio": skill.get('audio', ''),
-                "message": f"「{attacker['name']}」对「{defender['name']}」使用了「{skill['name']}」！"
-            })
-
-            total_damage = 0
-            for damage_type, base_damage in skill['damage'].items():
-                defender_resistance = 0
-                if 'attributes' in defender and defender['attributes']:
-                    for attr in defender['attributes']:
-                        if 'resistance' in attr and damage_type in attr['resistance']:
-                            defender_resistance = attr['resistance'][damage_type]
-                            break
-                actual_damage_for_type = max(0, base_damage - defender_resistance)
-                total_damage += actual_damage_for_type
-                
-            fluctuation_percentage = random.uniform(-0.15, 0.15)
-            damage_dealt = total_damage * (1 + fluctuation_percentage)
-            damage_dealt = max(0, round(damage_dealt))
-
-            defender_hp_before = defender['current_hp']
-            defender['current_hp'] -= damage_dealt
-            defender_hp_after = max(0, defender['current_hp'])
-
-            attacker['damage_dealt'] += damage_dealt
-            defender['damage_taken'] += damage_dealt
-
-            battle_steps.append({
-                "event": "deal_damage",
-                "attacker": attacker['name'],
-                "defender": defender['name'],
-                "skill": skill['name'],
-                "damage_dealt": damage_dealt,
-                "defender_hp_before": defender_hp_before,
-                "defender_hp_after": defender_hp_after,
-                "message": f"「{defender['name']}」受到了 {damage_dealt} 点伤害。"
-            })
-            battle_steps.append({"event": "hp_update", "character": defender['name'], "hp": defender_hp_after, "message": f"「{defender['name']}」剩余生命值: {defender_hp_after:.2f}"})
-
-            if defender['current_hp'] <= 0:
-                battle_steps.append({"event": "defeated", "character": defender['name'], "message": f"「{defender['name']}」已被击败！"})
-                # Check if only one character remains after this defeat
-                if len([c for c in all_characters if c['current_hp'] > 0]) <= 1:
-                    break # End battle if only one or zero characters remain
-
-        turn += 1
-        # Check if battle should end after all active fighters have taken their turn
-        if len([c for c in all_characters if c['current_hp'] > 0]) <= 1:
-            break
-
-    final_result_message = ""
-    remaining_characters = [c for c in all_characters if c['current_hp'] > 0]
-
-    if len(remaining_characters) == 1:
-        winner_char = remaining_characters[0]
-        final_result_message = f"大乱斗结束！恭喜「{winner_char['name']}」获得了最终胜利！"
-        
-        # Update win rates for the winner
-        win_rates = load_win_rates()
-        win_rates.setdefault(str(winner_char['id']), {"total_battles": 0, "wins": 0})
-        win_rates[str(winner_char['id'])]["total_battles"] += 1
-        win_rates[str(winner_char['id'])]["wins"] += 1
-        save_win_rates(win_rates)
-
-        # Update win rates for losers (all other characters)
-        for char in all_characters:
-            if char['id'] != winner_char['id']:
-                win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-                win_rates[str(char['id'])]["total_battles"] += 1
-        save_win_rates(win_rates)
-
-    elif not remaining_characters:
-        final_result_message = "大乱斗结束: 所有角色都被击败，平局！"
-        # Update win rates for all characters (as a draw)
-        win_rates = load_win_rates()
-        for char in all_characters:
-            win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-            win_rates[str(char['id'])]["total_battles"] += 1
-        save_win_rates(win_rates)
-    else:
-        final_result_message = "大乱斗结束: 平局！(达到最大回合数)"
-        # Update win rates for all characters (as a draw)
-        win_rates = load_win_rates()
-        for char in all_characters:
-            win_rates.setdefault(str(char['id']), {"total_battles": 0, "wins": 0})
-            win_rates[str(char['id'])]["total_battles"] += 1
-        save_win_rates(win_rates)
-
-    character_stats = []
-    for char in all_characters:
-        character_stats.append({
-            "name": char['name'],
-            "damage_dealt": char['damage_dealt'],
-            "damage_taken": char['damage_taken'],
-            "healing_done": char['healing_done']
+    for fighter in fighters:
+        stats = {"id": fighter.character.id, "name": fighter.character.name}
+        if not free_for_all:
+            stats["team"] = f"队伍{fighter.team + 1}"
+        stats.update({
+            "damage_dealt": fighter.damage_dealt,
+            "damage_taken": fighter.damage_taken,
+            "healing_done": fighter.healing_done
         })
-
-    battle_steps.append({"event": "end", "result": final_result_message, "character_stats": character_stats, "message": final_result_message})
-
-    return battle_steps, final_result_message
\ No newline at end of file
+        character_stats.append(stats)
+
+    yield {
+        "event": "end",
+        "result": final_result_message,
+        "character_stats": character_stats,
+        "message": final_result_message,
+        "winners": [f.character.id for f in winners],
+        "turns": turn
+    }
+
+class _AliveSet:
+    """Fighters still standing, with O(1) removal and uniform sampling.
+
+    Removal swaps the last fighter into the freed slot, so ``items`` is not
+    kept in roster order.
+    """
+    __slots__ = ('items', 'positions')
+
+    def __init__(self, fighters):
+        self.items = list(fighters)
+        self.positions = {f.position: i for i, f in enumerate(self.items)}
+
+    def __len__(self):
+        return len(self.items)
+
+    def remove(self, fighter):
+        i = self.positions.pop(fighter.position)
+        last = self.items.pop()
+        if last is not fighter:
+            self.items[i] = last
+            self.positions[last.position] = i
+
+    def sample_other(self, rng, fighter):
+        """Picks uniformly among the set without ``fighter`` (which must be in it)."""
+        i = rng.randrange(len(self.items) - 1)
+        if i >= self.positions[fighter.position]:
+            i += 1
+        return self.items[i]
+
+def _alive_team_count(teams):
+    return sum(1 for team in teams if any(f.current_hp > 0 for f in team))
+
+def _start_step(teams, battle_mode, seed):
+    if battle_mode == 'free_for_all':
+        all_characters = [f.character.source for team in teams for f in team]
+        character_names = ", ".join([c['name'] for c in all_characters])
+        return {"event": "start", "seed": seed, "message": f"大乱斗开始！参战角色: {character_names}", "characters": all_characters}
+    team1_names = ", ".join([f.character.name for f in teams[0]])
+    team2_names = ", ".join([f.character.name for f in teams[1]])
+    if battle_mode == '1v1':
+        return {"event": "start", "seed": seed, "message": f"1V1 战斗开始: 「{team1_names}」 vs 「{team2_names}」"}
+    title = f"{len(teams[0])}V{len(teams[1])}"
+    return {"event": "start", "seed": seed, "message": f"{title} 战斗开始: 队伍1 ({team1_names}) vs 队伍2 ({team2_names})"}
+
+def _result_message(teams, battle_mode, winners):
+    if battle_mode == 'free_for_all':
+        if winners:
+            return f"大乱斗结束！恭喜「{winners[0].character.name}」获得了最终胜利！"
+        if not any(f.current_hp > 0 for team in teams for f in team):
+            return "大乱斗结束: 所有角色都被击败，平局！"
+        return "大乱斗结束: 平局！(达到最大回合数)"
+
+    if not winners:
+        if any(f.current_hp > 0 for team in teams for f in team):
+            return "战斗结束: 平局！(达到最大回合数)"
+        return "战斗结束: 平局！(双方队伍都被击败)"
+
+    # 计算MVP
+    mvp = None
+    max_damage = -1
+    for fighter in winners:
+        if fighter.damage_dealt > max_damage:
+            max_damage = fighter.damage_dealt
+            mvp = fighter
+    mvp_name = mvp.character.name
+
+    team_number = mvp.team + 1
+    if len(winners) == 1:
+        return f"恭喜「{mvp_name}」获得了胜利！"
+    if len(winners) == 2:
+        other_winner = next(f for f in winners if f is not mvp)
+        return f"恭喜「{mvp_name}」获得了MVP，「{other_winner.character.name}」是躺赢狗！"
+    return f"恭喜队伍 {team_number} 获得了胜利，MVP 是「{mvp_name}」！"
+
+def with_message(step):
+    """Adds the formatted ``message`` to a per-turn step (start/end already have one)."""
+    if "message" not in step:
+        step["message"] = format_message(step)
+    return step
+
+def collect_steps(events):
+    """Full-log sink: returns (steps, result) like simulate_battle."""
+    battle_steps = [with_message(step) for step in events]
+    return battle_steps, battle_steps[-1]["result"]
+
+def battle_outcome(events):
+    """Outcome-only sink: drains ``events`` and returns the end step.
+
+    Pair it with ``log=False`` so no per-turn steps are built at all.
+    """
+    end = None
+    for step in events:
+        end = step
+    return end
+
+class BattleStats:
+    """Stats sink: aggregates the outcomes of many battles per character id."""
+
+    def __init__(self):
+        self.battles = 0
+        self.draws = 0
+        self.turns = 0
+        self.characters = {}
+
+    def add(self, events):
+        """Consumes one battle's events and returns its end step."""
+        end = battle_outcome(events)
+        self.battles += 1
+        self.turns += end["turns"]
+        if not end["winners"]:
+            self.draws += 1
+        winners = set(end["winners"])
+        for char in end["character_stats"]:
+            entry = self.characters.setdefault(char["id"], {"name": char["name"], "battles": 0, "wins": 0, "damage_dealt": 0, "damage_taken": 0})
+            entry["battles"] += 1
+            entry["wins"] += char["id"] in winners
+            entry["damage_dealt"] += char["damage_dealt"]
+            entry["damage_taken"] += char["damage_taken"]
+        return end
+
+    def summary(self):
+        return {
+            "battles": self.battles,
+            "draws": self.draws,
+            "mean_turns": self.turns / self.battles if self.battles else 0,
+            "characters": {
+                char_id: dict(entry, win_rate=entry["wins"] / entry["battles"])
+                for char_id, entry in self.characters.items()
+            },
+        }
+
+def stream_chunks(events, encode, on_end=None):
+    """Stream-writer sink: yields the encoded steps, one chunk per turn.
+
+    ``on_end`` may return a replacement for the end step (e.g. to attach a
+    replay id) before it is encoded.
+    """
+    chunk = []
+    for step in events:
+        if step['event'] == 'turn_start' and chunk:
+            yield ''.join(chunk)
+            chunk = []
+        if step['event'] == 'end' and on_end is not None:
+            step = on_end(step)
+        chunk.append(encode(with_message(step)))
+    if chunk:
+        yield ''.join(chunk)
\ No newline at end of file
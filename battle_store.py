@@ -0,0 +1,70 @@
+"""Server-side storage for interactive (pokemon-style) battle state.
+
+Battle state used to live in the signed session cookie, which grew every
+turn. Now only the battle id goes to the client; the state is kept here,
+keyed by battle id, in an in-process LRU with TTL eviction. Another backend
+(e.g. Redis, for several worker processes) can be plugged in by passing any
+object with ``get``/``set``/``delete`` to ``BattleStore``.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MAX_BATTLES = 1000
+BATTLE_TTL = 60 * 60 # 秒；超过该时间未操作的战斗会被清除
+
+class MemoryBackend:
+    """Thread-safe LRU mapping with per-entry expiry."""
+
+    def __init__(self, max_entries=MAX_BATTLES, ttl=BATTLE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # battle_id -> (expires_at, state)
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._entries:
+            battle_id, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[battle_id]
+
+    def get(self, battle_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(battle_id)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[battle_id]
+                return None
+            self._entries[battle_id] = (now + self.ttl, entry[1])
+            self._entries.move_to_end(battle_id)
+            return entry[1]
+
+    def set(self, battle_id, state):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[battle_id] = (now + self.ttl, state)
+            self._entries.move_to_end(battle_id)
+            self._evict(now)
+
+    def delete(self, battle_id):
+        with self._lock:
+            self._entries.pop(battle_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class BattleStore:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+
+    def get(self, battle_id):
+        return self.backend.get(battle_id) if battle_id else None
+
+    def save(self, state):
+        self.backend.set(state['battle_id'], state)
+
+    def delete(self, battle_id):
+        self.backend.delete(battle_id)
@@ -4,31 +4,51 @@ import os
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
 import shutil
+from repository import CharacterIndex, create_store
+from matchup_cache import invalidate_spilled
 
-DATA_FILE = 'data/characters.json'
 ELEMENTS = ["金", "木", "水", "火", "土", "风", "雷", "毒", "法", "圣", "精神"]
 
+store = create_store()
+
 def load_characters():
-    """从JSON文件加载角色数据"""
-    if not os.path.exists(DATA_FILE):
-        return {"characters": []}
+    """从存储后端（JSON 文件或 SQLite）加载角色数据"""
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return {"characters": store.load()}
     except json.JSONDecodeError:
         messagebox.showerror("错误", "characters.json 文件格式错误，将创建新文件。")
         return {"characters": []}
 
-def save_characters(data):
-    """将角色数据保存到JSON文件"""
+def save_characters(data, character=None):
+    """将角色数据保存到存储后端；指定 character 时只写入该角色（SQLite 下为单行更新）"""
+    try:
+        if character is not None:
+            store.upsert(character)
+        else:
+            store.save_all(data['characters'])
+        return True
+    except Exception as e:
+        messagebox.showerror("保存错误", f"保存文件时发生错误: {e}")
+        return False
+
+def insert_character(character):
+    """新增角色：ID 由存储在锁内分配（max(id)+1），不会覆盖其他进程刚创建的角色"""
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        store.insert_new(character)
         return True
     except Exception as e:
         messagebox.showerror("保存错误", f"保存文件时发生错误: {e}")
         return False
 
+def delete_character_from_store(char_id):
+    """只删除该角色（在锁内重新读取），不会用本窗口的旧数据覆盖其他进程的修改"""
+    try:
+        store.delete(char_id)
+        return True
+    except Exception as e:
+        messagebox.showerror("删除错误", f"删除角色时发生错误: {e}")
+        return False
+
 class CharacterManagerGUI:
     def __init__(self, master):
         self.master = master
@@ -36,6 +56,7 @@ class CharacterManagerGUI:
         master.geometry("800x600")
 
         self.data = load_characters()
+        self.index = CharacterIndex(self.data['characters'])
 
         self.create_widgets()
         self.refresh_character_list()
@@ -78,6 +99,7 @@ class CharacterManagerGUI:
             self.character_tree.delete(i)
         
         self.data = load_characters() # 重新加载数据以确保最新
+        self.index = CharacterIndex(self.data['characters'])
         for char in self.data['characters']:
             self.character_tree.insert("", tk.END, iid=char['id'], 
                                        values=(char['id'], char['name'], char['stats']['hp'], char['element']))
@@ -97,7 +119,7 @@ class CharacterManagerGUI:
             return
         
         char_id = int(selected_item[0]) # 直接使用item_id作为char_id
-        character = next((c for c in self.data['characters'] if c['id'] == char_id), None)
+        character = self.index.get(char_id)
 
         if character:
             detail_window = tk.Toplevel(self.master)
@@ -136,7 +158,7 @@ class CharacterManagerGUI:
                 return
             char_id = int(selected_item[0]) # 直接使用item_id作为char_id
         
-        character = next((c for c in self.data['characters'] if c['id'] == char_id), None)
+        character = self.index.get(char_id)
         if character:
             AddEditCharacterWindow(self.master, self.data, self.refresh_character_list, character)
         else:
@@ -153,10 +175,9 @@ class CharacterManagerGUI:
         char_name = self.character_tree.item(selected_item[0], 'values')[1]
 
         if messagebox.askyesno("确认删除", f"确定要删除角色 '{char_name}' (ID: {char_id}) 吗？"):
-            original_len = len(self.data['characters'])
-            self.data['characters'] = [char for char in self.data['characters'] if char['id'] != char_id]
-            if len(self.data['characters']) < original_len:
-                if save_characters(self.data):
+            if self.index.get(char_id) is not None:
+                if delete_character_from_store(char_id):
+                    invalidate_spilled([char_id])
                     messagebox.showinfo("成功", f"角色 '{char_name}' (ID: {char_id}) 已删除。")
                     self.refresh_character_list()
             else:
@@ -464,11 +485,11 @@ class AddEditCharacterWindow(tk.Toplevel):
                     "element": element
                 })
                 message = f"角色 '{name}' (ID: {self.character['id']}) 已更新。"
+                changed_character = self.character
+                saved = save_characters(self.data, changed_character)
             else:
-                # 添加新角色
-                new_id = max([c['id'] for c in self.data['characters']]) + 1 if self.data['characters'] else 1
-                new_character = {
-                    "id": new_id,
+                # 添加新角色（ID 由存储分配）
+                changed_character = {
                     "name": name,
                     "stats": {"hp": hp},
                     "skills": skills,
@@ -477,10 +498,12 @@ class AddEditCharacterWindow(tk.Toplevel):
                     "attributes": attributes,
                     "element": element
                 }
-                self.data['characters'].append(new_character)
-                message = f"角色 '{name}' (ID: {new_id}) 已添加。"
+                saved = insert_character(changed_character)
+                message = f"角色 '{name}' (ID: {changed_character.get('id')}) 已添加。"
 
-            if save_characters(self.data):
+            if saved:
+                # 丢弃磁盘上包含该角色的对局统计缓存（Web 端重新加载角色时会清理内存中的部分）
+                invalidate_spilled([changed_character['id']])
                 messagebox.showinfo("成功", message)
                 self.refresh_callback()
                 self.destroy() # 关闭窗口
@@ -0,0 +1,83 @@
+"""Precompiled skill-vs-resistance damage.
+
+A skill is compiled into the (damage type, value) pairs it lists and a
+character into a damage type → resistance map, so the base damage of a
+skill against a defender is ``Σ max(0, value - resistance)`` over a handful
+of pairs instead of a walk over the raw skill and attribute dicts.
+
+The resistance map follows the engine's original rule: for every damage
+type the *first* attribute whose ``resistance`` mentions that type wins.
+"""
+
+# 超过这个人数时按需计算伤害表（大乱斗），否则创建时全部预计算
+EAGER_LIMIT = 64
+
+def damage_items(skill):
+    """(damage type, value) pairs of a skill; types it does not list (or lists as None) are left out."""
+    damage = (skill.get('damage') if isinstance(skill, dict) else None) or {}
+    return tuple((damage_type, value) for damage_type, value in damage.items() if value is not None)
+
+def resistance_map(character):
+    resistances = {}
+    for attr in character.get('attributes') or []:
+        resistance = attr.get('resistance') if isinstance(attr, dict) else None
+        if not resistance:
+            continue
+        for damage_type, value in resistance.items():
+            # 同一元素以第一个出现的属性为准
+            if damage_type not in resistances:
+                resistances[damage_type] = value
+    return resistances
+
+def base_damage(items, resistances):
+    """Total damage before fluctuation: Σ max(0, damage - resistance)."""
+    total = 0
+    for damage_type, value in items:
+        value -= resistances.get(damage_type, 0)
+        if value > 0:
+            total += value
+    return total
+
+def skill_damage(skill, defender):
+    """Base damage of one skill against one defender (no precomputation)."""
+    return base_damage(damage_items(skill), resistance_map(defender))
+
+class DamageMatrix:
+    """Base damage for every (attacker, skill, defender) of a roster.
+
+    Characters are addressed by position in the list passed to the
+    constructor. Small rosters are fully precomputed; large ones fill the
+    table lazily on first use of each pair.
+    """
+
+    def __init__(self, characters, eager=None):
+        self.characters = list(characters)
+        self.skill_items = [
+            [damage_items(skill) for skill in char.get('skills') or []]
+            for char in self.characters
+        ]
+        self.resistances = [resistance_map(char) for char in self.characters]
+        self._positions = {id(char): i for i, char in enumerate(self.characters)}
+        if eager is None:
+            eager = len(self.characters) <= EAGER_LIMIT
+        self._table = {}
+        if eager:
+            for a, skills in enumerate(self.skill_items):
+                for s, items in enumerate(skills):
+                    for d, resistances in enumerate(self.resistances):
+                        self._table[a, s, d] = base_damage(items, resistances)
+
+    def position(self, character):
+        return self._positions[id(character)]
+
+    def get(self, attacker_pos, skill_index, defender_pos):
+        key = (attacker_pos, skill_index, defender_pos)
+        value = self._table.get(key)
+        if value is None:
+            value = self._table[key] = base_damage(
+                self.skill_items[attacker_pos][skill_index], self.resistances[defender_pos])
+        return value
+
+    def damage(self, attacker, skill_index, defender):
+        """Base damage of ``attacker``'s skill ``skill_index`` against ``defender``."""
+        return self.get(self.position(attacker), skill_index, self.position(defender))
@@ -0,0 +1,93 @@
+"""Immutable character definitions and per-battle fighter state.
+
+The engine used to write ``current_hp``/``damage_dealt``/... straight into
+the character dicts, so every battle needed its own copies of them. Now a
+battle compiles each participant into a CompiledCharacter (read-only, it
+only references the roster's data) and keeps everything that changes during
+the fight in a small FighterState. One cached roster can therefore be shared
+by any number of concurrent battles without copying.
+
+Compiling also builds the skill table the engine's hot loop reads: each
+skill's damage pairs and the character's resistance map (see damage.py).
+Compiled characters are memoized per character dict, so a cached roster is
+compiled once, not once per battle; dicts must therefore not be modified in
+place after they have fought (the repository replaces them on edit).
+"""
+import threading
+from collections import namedtuple
+
+from damage import damage_items, resistance_map
+
+COMPILE_CACHE_SIZE = 4096
+
+# 对战规则常量，参考引擎（battle.py）和批量引擎（simulation/lockstep/odds）共用
+MAX_TURNS = 200 # 最大回合数，防止无限战斗；达到后判平局
+FLUCTUATION = 0.15 # 伤害波动范围 ±15%
+
+CompiledCharacter = namedtuple('CompiledCharacter', ['id', 'name', 'hp', 'skills', 'skill_items', 'resistances', 'source'])
+
+_compiled = {} # id(角色字典) -> CompiledCharacter；条目持有该字典，id 不会被复用
+_compiled_lock = threading.Lock()
+
+def compile_character(char):
+    """Returns the read-only battle definition of a character dict."""
+    if isinstance(char, CompiledCharacter):
+        return char
+    compiled = _compiled.get(id(char))
+    if compiled is not None and compiled.source is char:
+        return compiled
+    skills = tuple(char.get('skills') or ())
+    compiled = CompiledCharacter(
+        char['id'], char['name'], char['stats']['hp'], skills,
+        tuple(damage_items(skill) for skill in skills), resistance_map(char), char)
+    with _compiled_lock:
+        if len(_compiled) >= COMPILE_CACHE_SIZE:
+            del _compiled[next(iter(_compiled))]
+        _compiled[id(char)] = compiled
+    return compiled
+
+class FighterState:
+    """Mutable state of one participant for the duration of one battle.
+
+    ``name``, ``skill_items`` and ``resistances`` are copied from the compiled
+    character so the turn loop reads them with a single attribute lookup.
+    """
+    __slots__ = ('character', 'name', 'skill_items', 'resistances', 'position', 'team',
+                 'current_hp', 'damage_dealt', 'damage_taken', 'healing_done')
+
+    def __init__(self, character, position, team):
+        self.character = character
+        self.name = character.name
+        self.skill_items = character.skill_items
+        self.resistances = character.resistances
+        self.position = position # 在本场战斗参战者中的序号
+        self.team = team
+        self.current_hp = character.hp
+        self.damage_dealt = 0
+        self.damage_taken = 0
+        self.healing_done = 0 # Placeholder for future healing mechanics
+
+def create_fighters(teams):
+    """Compiles ``teams`` (lists of character dicts) into per-team FighterState lists."""
+    fighter_teams = []
+    position = 0
+    for team_index, team in enumerate(teams):
+        fighter_team = []
+        for char in team:
+            fighter_team.append(FighterState(compile_character(char), position, team_index))
+            position += 1
+        fighter_teams.append(fighter_team)
+    return fighter_teams
+
+def battle_view(char):
+    """A per-battle dict for interactive battles: the character's fields plus fresh battle stats.
+
+    Only the top level is new; skills, stats and attributes are shared with
+    the roster and must not be modified.
+    """
+    view = dict(char)
+    view['current_hp'] = char['stats']['hp']
+    view['damage_dealt'] = 0
+    view['damage_taken'] = 0
+    view['healing_done'] = 0
+    return view
@@ -0,0 +1,186 @@
+"""Background jobs for long simulations (big free-for-alls, tournaments).
+
+A job is a function ``func(job)`` submitted to a JobQueue. It runs on a
+bounded thread pool instead of a request thread, and the client gets a job
+id back immediately. While it runs the function publishes progress and
+partial results with ``job.report``, which also raises JobCancelled once
+the job has been cancelled, so cancellation takes effect at the next report.
+Clients poll ``Job.to_dict`` or follow ``Job.wait`` to stream new events.
+
+At most ``max_running`` jobs run at once and at most ``max_queued`` more
+wait; beyond that ``submit`` raises JobQueueFull so the web tier can answer
+"busy" instead of piling up work. Jobs live in process memory; finished
+ones are kept for ``ttl`` seconds (and at most ``max_finished`` of them).
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_RUNNING_JOBS = 2
+MAX_QUEUED_JOBS = 16
+MAX_FINISHED_JOBS = 200
+JOB_TTL = 60 * 60 # 秒；结束后保留结果的时间
+
+FINISHED = ('done', 'failed', 'cancelled')
+
+class JobQueueFull(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, params=None):
+        self.id = secrets.token_urlsafe(8)
+        self.kind = kind
+        self.params = params or {}
+        self.status = 'queued'
+        self.progress = 0.0
+        self.events = [] # 部分结果，只追加
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    def check(self):
+        """Raises JobCancelled if the job has been cancelled."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def report(self, progress=None, event=None):
+        """Publishes progress (0..1) and/or one partial-result event dict."""
+        self.check()
+        with self._changed:
+            if progress is not None:
+                self.progress = min(1.0, max(0.0, progress))
+            if event is not None:
+                self.events.append(event)
+            self._changed.notify_all()
+
+    def _set_status(self, status, result=None, error=None):
+        with self._changed:
+            self.status = status
+            if status == 'running':
+                self.started_at = time.time()
+            elif status in FINISHED:
+                self.finished_at = time.time()
+                self.result = result
+                self.error = error
+                if status == 'done':
+                    self.progress = 1.0
+            self._changed.notify_all()
+
+    def wait(self, since=0, timeout=None):
+        """Blocks until there are events after index ``since`` or the job finished.
+
+        Returns (new events, finished). Returns early with no events after ``timeout``.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > since or self.finished, timeout)
+            return self.events[since:], self.finished
+
+    def to_dict(self, since=None):
+        """Job status; includes ``events[since:]`` when ``since`` is given."""
+        with self._changed:
+            data = {
+                "job_id": self.id,
+                "kind": self.kind,
+                "params": self.params,
+                "status": self.status,
+                "progress": self.progress,
+                "event_count": len(self.events),
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+            if since is not None:
+                data["events"] = self.events[since:]
+            if self.status == 'done':
+                data["result"] = self.result
+            elif self.status == 'failed':
+                data["error"] = self.error
+        return data
+
+class JobQueue:
+    def __init__(self, max_running=MAX_RUNNING_JOBS, max_queued=MAX_QUEUED_JOBS,
+                 max_finished=MAX_FINISHED_JOBS, ttl=JOB_TTL):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict() # job_id -> Job，按提交顺序
+        self._active = 0 # 排队中 + 运行中
+
+    def submit(self, kind, func, params=None):
+        """Queues ``func(job)`` and returns the Job; raises JobQueueFull when at capacity."""
+        job = Job(kind, params)
+        with self._lock:
+            if self._active >= self.max_running + self.max_queued:
+                raise JobQueueFull(f"{self._active} jobs are already queued or running.")
+            self._active += 1
+            self._jobs[job.id] = job
+            self._trim()
+        job._future = self._executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job, func):
+        try:
+            if job._cancel.is_set():
+                job._set_status('cancelled')
+                return
+            job._set_status('running')
+            try:
+                result = func(job)
+            except JobCancelled:
+                job._set_status('cancelled')
+            except Exception as e:
+                print(f"Error: job {job.id} ({job.kind}) failed: {e}")
+                job._set_status('failed', error=str(e))
+            else:
+                job._set_status('done', result=result)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job. Returns the Job, or None if unknown."""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        job._cancel.set()
+        if job._future is not None and job._future.cancel():
+            # 还没开始运行，_run 不会再被调用
+            job._set_status('cancelled')
+            with self._lock:
+                self._active -= 1
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {"active": self._active, "max_running": self.max_running, "max_queued": self.max_queued}
+
+    def _trim(self):
+        """Drops expired finished jobs and the oldest finished ones beyond max_finished."""
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(finished) - self.max_finished
+        for job in finished:
+            if excess > 0 or now - job.finished_at > self.ttl:
+                del self._jobs[job.id]
+                excess -= 1
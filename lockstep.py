@@ -0,0 +1,225 @@
+"""Vectorized batch simulation: many independent battles advanced in lockstep.
+
+The same matchup is played ``battles`` times at once. HP, damage dealt and
+the per-turn random draws are NumPy arrays with one row per battle, so a
+turn costs a few array operations for the whole batch instead of a Python
+loop per battle. Rules are those of ``battle.simulate_battle`` /
+simulation.py: a fresh random turn order every turn, uniform skill and
+defender choice among living opponents, ±15% fluctuation rounded half to
+even and floored at zero, and a draw after MAX_TURNS. Battles that finish
+are masked out for the rest of the turn and dropped from the arrays at its
+end.
+
+The random stream is NumPy's, so results match simulation.simulate_matchup
+in distribution, not battle for battle. NumPy is optional: without it this
+module imports fine and ``simulate_matchup`` raises ImportError.
+"""
+import hashlib
+import itertools
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from fighter import MAX_TURNS
+from simulation import FLUCTUATION_BASE, FLUCTUATION_WIDTH, compile_matchup
+
+BATCH_SIZE = 1 << 16 # 每批同时推进的对战数，限制内存占用
+MAX_FIGHTERS = 10 # 按存活位掩码建表，表大小随人数指数增长
+PERMUTATION_LIMIT = 6 # 人数不超过此值时从预先列出的全排列中抽取行动顺序
+
+def available():
+    return np is not None
+
+def _generator(seed):
+    """NumPy generator for ``seed`` (any value accepted by ``random.Random``)."""
+    if seed is not None and not isinstance(seed, int):
+        seed = int.from_bytes(hashlib.sha256(str(seed).encode('utf-8')).digest(), 'big')
+    elif isinstance(seed, int) and seed < 0:
+        seed = -seed
+    return np.random.default_rng(seed)
+
+def _compile_tables(team1, team2, matrix):
+    """Flat NumPy tables for one matchup; fighters are numbered team1 first."""
+    hp, team_of, members, damage = compile_matchup(team1, team2, matrix)
+    count = len(hp)
+    if count > MAX_FIGHTERS:
+        raise ValueError(f"lockstep supports at most {MAX_FIGHTERS} fighters per battle, got {count}")
+    n_skills = np.array([len(skills) for skills in damage], dtype=np.int64)
+    # base[a, s, d]：技能数不足的角色用 0 填充，不会被选中
+    base = np.zeros((count, max(1, int(n_skills.max(initial=0))), count))
+    for a, skills in enumerate(damage):
+        for s, row in enumerate(skills):
+            base[a, s] = row
+
+    # 存活角色用位掩码表示；targets[a, mask, r] 是掩码 mask 下攻击者 a 的第 r 个存活对手
+    team_bits = [sum(1 << i for i in team) for team in members]
+    enemy_bits = np.array([team_bits[1 - t] for t in team_of], dtype=np.int64)
+    masks = 1 << count
+    targets = np.zeros((count, masks, max(1, *map(len, members))), dtype=np.int64)
+    target_counts = np.zeros((count, masks), dtype=np.int64)
+    for a in range(count):
+        enemies = members[1 - team_of[a]]
+        for mask in range(masks):
+            alive = [d for d in enemies if mask >> d & 1]
+            target_counts[a, mask] = len(alive)
+            targets[a, mask, :len(alive)] = alive
+
+    permutations = None
+    if count <= PERMUTATION_LIMIT:
+        permutations = np.array(list(itertools.permutations(range(count))), dtype=np.int64)
+    start_mask = sum(1 << i for i, value in enumerate(hp) if value > 0)
+    return {
+        'count': count,
+        'hp': np.array(hp, dtype=np.float64),
+        'team_bits': team_bits,
+        'enemy_bits': enemy_bits,
+        'n_skills': n_skills,
+        'base': base,
+        'targets': targets,
+        'target_counts': target_counts,
+        'permutations': permutations,
+        'start_mask': start_mask,
+    }
+
+def _run_batch(gen, tables, size, totals):
+    """Plays ``size`` battles to the end and adds their outcomes to ``totals``."""
+    count = tables['count']
+    bits1, bits2 = tables['team_bits']
+    enemy_bits = tables['enemy_bits']
+    n_skills = tables['n_skills']
+    skill_stride = tables['base'].shape[1] * count
+    base = tables['base'].reshape(-1)
+    masks = tables['target_counts'].shape[1]
+    max_targets = tables['targets'].shape[2]
+    targets = tables['targets'].reshape(-1)
+    target_counts = tables['target_counts'].reshape(-1)
+    permutations = tables['permutations']
+
+    hp = np.tile(tables['hp'], (size, 1))
+    dealt = np.zeros((size, count)) # 伤害都是取整后的值，用浮点数存储省去类型转换
+    alive = np.full(size, tables['start_mask'], dtype=np.int64)
+
+    def finish(done, turn):
+        alive1 = (alive[done] & bits1) != 0
+        alive2 = (alive[done] & bits2) != 0
+        totals['outcomes'][0] += int(np.count_nonzero(alive1 & ~alive2))
+        totals['outcomes'][1] += int(np.count_nonzero(alive2 & ~alive1))
+        totals['outcomes'][2] += int(np.count_nonzero(alive1 == alive2))
+        totals['turns'][turn] += int(np.count_nonzero(done))
+        values = dealt[done]
+        totals['dmg_sum'] += values.sum(axis=0)
+        totals['dmg_sq'] += (values ** 2).sum(axis=0)
+        np.minimum(totals['dmg_min'], values.min(axis=0), out=totals['dmg_min'])
+        np.maximum(totals['dmg_max'], values.max(axis=0), out=totals['dmg_max'])
+
+    # 所有对战的初始状态相同，开局就分出胜负时整批在第 0 回合结束
+    if not (tables['start_mask'] & bits1 and tables['start_mask'] & bits2):
+        finish(np.ones(size, dtype=bool), 0)
+        return
+
+    turn = 0
+    while len(hp) and turn < MAX_TURNS:
+        turn += 1
+        n = len(hp)
+        # 按扁平下标访问 [对战, 角色]，比二维花式索引快
+        flat_hp = hp.reshape(-1)
+        flat_dealt = dealt.reshape(-1)
+        offsets = np.arange(n) * count
+        live = np.ones(n, dtype=bool)
+        # 每场对战各自的随机行动顺序；本回合开始前已倒下的角色轮到时直接跳过
+        if permutations is not None:
+            order = permutations[gen.integers(len(permutations), size=n)].T
+        else:
+            order = np.argsort(gen.random((n, count)), axis=1).T
+        for attacker in order:
+            # 一个均匀数同时决定技能（整数部分）和伤害波动（小数部分，仍是独立的均匀分布）
+            if max_targets == 1:
+                draws = gen.random(n)
+            else:
+                draws, defender_draws = gen.random((2, n))
+            acting = live & ((alive >> attacker) & 1).astype(bool) & (n_skills[attacker] > 0)
+            scaled = draws * n_skills[attacker]
+            skill = scaled.astype(np.int64)
+            # 在存活的对手中均匀选择第 r 个
+            key = attacker * masks + alive
+            if max_targets == 1:
+                defender = targets[key]
+            else:
+                r = (defender_draws * target_counts[key]).astype(np.int64)
+                defender = targets[key * max_targets + r]
+            damage = np.rint(base[attacker * skill_stride + skill * count + defender] * (FLUCTUATION_BASE + FLUCTUATION_WIDTH * (scaled - skill)))
+            np.maximum(damage, 0, out=damage)
+            damage *= acting
+            defender_index = offsets + defender
+            flat_hp[defender_index] -= damage
+            flat_dealt[offsets + attacker] += damage
+            killed = acting & (flat_hp[defender_index] <= 0)
+            if not killed.any():
+                continue
+            rows = np.flatnonzero(killed)
+            alive[rows] &= ~(1 << defender[rows])
+            # 防御者所在队伍全灭的对战在此结束
+            rows = rows[(alive[rows] & enemy_bits[attacker[rows]]) == 0]
+            if len(rows):
+                done = np.zeros(n, dtype=bool)
+                done[rows] = True
+                finish(done, turn)
+                live[rows] = False
+        hp, dealt, alive = hp[live], dealt[live], alive[live]
+
+    if len(hp):
+        finish(np.ones(len(hp), dtype=bool), MAX_TURNS) # 达到最大回合数，平局
+
+def simulate_matchup(team1, team2, battles=1000, seed=None, matrix=None, batch_size=BATCH_SIZE):
+    """Vectorized counterpart of simulation.simulate_matchup; returns the same dict.
+
+    Battles are run ``batch_size`` at a time. Requires NumPy.
+    """
+    if np is None:
+        raise ImportError("lockstep.simulate_matchup requires NumPy (pip install numpy)")
+    gen = _generator(seed)
+    tables = _compile_tables(team1, team2, matrix)
+    fighters = list(team1) + list(team2)
+    count = len(fighters)
+    totals = {
+        'outcomes': [0, 0, 0], # team1 胜, team2 胜, 平局
+        'turns': np.zeros(MAX_TURNS + 1, dtype=np.int64),
+        'dmg_sum': np.zeros(count),
+        'dmg_sq': np.zeros(count),
+        'dmg_min': np.full(count, np.inf),
+        'dmg_max': np.zeros(count),
+    }
+    remaining = battles
+    while remaining > 0:
+        size = min(batch_size, remaining)
+        _run_batch(gen, tables, size, totals)
+        remaining -= size
+
+    team_of = [0] * len(team1) + [1] * len(team2)
+    damage_stats = {}
+    for i, char in enumerate(fighters):
+        mean = float(totals['dmg_sum'][i]) / battles if battles else 0
+        variance = float(totals['dmg_sq'][i]) / battles - mean * mean if battles else 0
+        damage_stats[char['id']] = {
+            "team": team_of[i] + 1,
+            "mean": mean,
+            "stdev": math.sqrt(max(0, variance)),
+            "min": int(totals['dmg_min'][i]) if battles else 0,
+            "max": int(totals['dmg_max'][i]),
+        }
+
+    outcomes = totals['outcomes']
+    turns = totals['turns']
+    return {
+        "battles": battles,
+        "wins": outcomes[0],
+        "losses": outcomes[1],
+        "draws": outcomes[2],
+        "win_rate": outcomes[0] / battles if battles else 0,
+        "mean_turns": int((turns * np.arange(len(turns))).sum()) / battles if battles else 0,
+        "turns_histogram": {turn: int(n) for turn, n in enumerate(turns) if n},
+        "damage_dealt": damage_stats,
+    }
@@ -0,0 +1,226 @@
+"""Simulated matchup statistics, cached by character content.
+
+A cached result is keyed by the participant ids in team order and a hash of
+what decides the outcome: the compiled definition of every participant (HP,
+skill damage pairs, resistance map; see fighter.compile_character), the
+battle ENGINE_VERSION, the batch simulator used, the number of battles and
+the seed. Renaming a character or changing its image does not invalidate
+anything; changing its numbers gives new keys. The ids are part of the key
+because ``damage_dealt`` is reported per id: two characters with identical
+numbers still get separate entries.
+
+The newest ``max_entries`` results are kept in memory (LRU). Evicted ones
+are spilled to ``directory`` as JSON and read back on a later miss
+(``directory=None`` keeps the cache in memory only). Files
+are named after the participant ids, so ``invalidate`` (and
+``invalidate_spilled`` from other processes such as the Tk tool) can drop
+exactly the pairings that include an edited character.
+
+Values are stored as JSON would store them (character ids in
+``damage_dealt`` become strings) whether they come from memory or disk.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from fighter import compile_character
+from persistence import atomic_write_bytes
+
+CACHE_DIR = 'data/matchup_cache'
+MAX_CACHE_ENTRIES = 4096
+MAX_SPILL_FILES = 50000
+HASH_CACHE_SIZE = 4096
+
+_SPILL_NAME = re.compile(r'^([0-9-]+)_([0-9-]+)_[0-9a-f]{32}\.json$')
+
+_hashes = {} # id(角色字典) -> (角色字典, 哈希)；条目持有该字典，id 不会被复用
+_hashes_lock = threading.Lock()
+
+def character_hash(char):
+    """Stable hash of the parts of a character that affect a battle's outcome.
+
+    Memoized per character dict like fighter.compile_character (dicts are
+    replaced, not modified, on edit).
+    """
+    entry = _hashes.get(id(char))
+    if entry is not None and entry[0] is char:
+        return entry[1]
+    compiled = compile_character(char)
+    content = [
+        compiled.hp,
+        [list(map(list, items)) for items in compiled.skill_items],
+        sorted(compiled.resistances.items()),
+    ]
+    digest = hashlib.sha256(json.dumps(content, ensure_ascii=False).encode('utf-8')).hexdigest()
+    with _hashes_lock:
+        if len(_hashes) >= HASH_CACHE_SIZE:
+            del _hashes[next(iter(_hashes))]
+        _hashes[id(char)] = (char, digest)
+    return digest
+
+def matchup_key(team1, team2, battles, seed, engine):
+    from battle import ENGINE_VERSION # 延迟导入：Tk 工具只用 invalidate_spilled，无需加载对战模块
+
+    # 结果中的 damage_dealt 按角色 id 记录，所以 id 也是键的一部分（内容相同的角色各自缓存）
+    content = [
+        ENGINE_VERSION, engine, battles, str(seed),
+        [[c['id'], character_hash(c)] for c in team1], [[c['id'], character_hash(c)] for c in team2],
+    ]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()[:32]
+
+def _spill_name(team1_ids, team2_ids, key):
+    return f"{'-'.join(map(str, team1_ids))}_{'-'.join(map(str, team2_ids))}_{key}.json"
+
+def _spilled_ids(name):
+    match = _SPILL_NAME.match(name)
+    if not match:
+        return None
+    return {int(i) for part in match.groups() for i in part.split('-') if i}
+
+def invalidate_spilled(char_ids, directory=CACHE_DIR):
+    """Deletes spilled results of every pairing that includes one of ``char_ids``.
+
+    For processes that edit characters but do not hold the cache (the Tk tool);
+    the web app drops its in-memory entries when the repository reloads.
+    """
+    char_ids = set(char_ids)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for name in names:
+        ids = _spilled_ids(name)
+        if ids and ids & char_ids:
+            try:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+class MatchupCache:
+    def __init__(self, directory=CACHE_DIR, max_entries=MAX_CACHE_ENTRIES, max_files=MAX_SPILL_FILES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (参战 id 集合, 文件名, 结果)
+        self._spilled = None # 已溢出的文件数估计值，首次溢出时扫描
+        self._cleanup_ids = set() # 等待后台线程删除其溢出文件的角色 id
+        self._cleanup_thread = None
+
+    def get(self, team1, team2, battles, seed, engine):
+        """Returns the cached result for this matchup, or None."""
+        key = matchup_key(team1, team2, battles, seed, engine)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[2]
+        if self.directory is None:
+            return None
+        name = _spill_name([c['id'] for c in team1], [c['id'] for c in team2], key)
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self._store(key, name, value)
+        return value
+
+    def put(self, team1, team2, battles, seed, engine, result):
+        """Caches ``result`` (a simulate_matchup dict) and returns it as the cache will serve it."""
+        key = matchup_key(team1, team2, battles, seed, engine)
+        name = _spill_name([c['id'] for c in team1], [c['id'] for c in team2], key)
+        value = json.loads(json.dumps(result, ensure_ascii=False))
+        self._store(key, name, value)
+        return value
+
+    def get_or_simulate(self, team1, team2, battles, seed, engine, simulate):
+        """Cached result, or ``simulate(team1, team2, battles, seed=seed)`` stored and returned."""
+        value = self.get(team1, team2, battles, seed, engine)
+        if value is None:
+            value = self.put(team1, team2, battles, seed, engine, simulate(team1, team2, battles, seed=seed))
+        return value
+
+    def _store(self, key, name, value):
+        ids = _spilled_ids(name)
+        evicted = []
+        with self._lock:
+            self._entries[key] = (ids, name, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for _, evicted_name, evicted_value in evicted:
+            self._spill(evicted_name, evicted_value)
+
+    def _spill(self, name, value):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            return
+        atomic_write_bytes(path, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        with self._lock:
+            if self._spilled is None:
+                self._spilled = len(os.listdir(self.directory))
+            else:
+                self._spilled += 1
+            if self._spilled <= self.max_files:
+                return
+            self._spilled = self._trim_spilled()
+
+    def _trim_spilled(self):
+        """Deletes the oldest spilled files until at most 3/4 of max_files remain."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not _SPILL_NAME.match(name):
+                continue # 跳过正在写入的临时文件
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        excess = len(entries) - self.max_files * 3 // 4
+        for _, name in entries[:max(0, excess)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        return len(entries) - max(0, excess)
+
+    def invalidate(self, char_ids):
+        """Forgets every cached pairing that includes one of ``char_ids``.
+
+        Registered as a repository listener, so it runs under the repository
+        lock: only the in-memory entries are dropped here, and the spilled
+        files are deleted by a background thread. Keys are content hashes,
+        so a file left over from the old content is never served meanwhile.
+        """
+        char_ids = set(char_ids)
+        with self._lock:
+            for key in [key for key, (ids, _, _) in self._entries.items() if ids & char_ids]:
+                del self._entries[key]
+            if self.directory is None:
+                return
+            self._cleanup_ids |= char_ids
+            if self._cleanup_thread is None:
+                self._cleanup_thread = threading.Thread(target=self._cleanup, name='matchup-cache-cleanup', daemon=True)
+                self._cleanup_thread.start()
+
+    def _cleanup(self):
+        """Deletes spilled files of invalidated characters until none are pending."""
+        while True:
+            with self._lock:
+                char_ids, self._cleanup_ids = self._cleanup_ids, set()
+                if not char_ids:
+                    self._cleanup_thread = None
+                    return
+            try:
+                invalidate_spilled(char_ids, self.directory)
+            except OSError as e:
+                print(f"Error: could not clean up spilled matchup results: {e}")
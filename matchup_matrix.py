@@ -0,0 +1,253 @@
+"""Roster-wide 1v1 win-probability matrix, maintained in the background.
+
+The matrix holds odds.solve_1v1 for every pair of characters. It is built
+once by a worker thread and afterwards kept current incrementally: the
+repository reports which characters changed, and the worker recomputes only
+their rows and columns (N-1 pairings per edited character instead of N²).
+Requests only ever read the latest finished state; while work is queued the
+snapshot says ``pending`` and may contain stale or missing (None) cells.
+
+Each unordered pair is solved once: P(b beats a) is the loss probability
+of a against b. Every character's best matchups and counters are derived
+by the worker, so the index page reads them in O(N) instead of rebuilding
+the N×N matrix per view. An incremental update recomputes the picks of the
+changed characters and merges their new cells into everyone else's, so
+editing one character costs O(N) there too.
+
+A failed update is retried with a full rebuild after RETRY_DELAY seconds,
+doubling up to MAX_RETRY_DELAY while it keeps failing.
+"""
+import threading
+import time
+
+PICKS_LIMIT = 3
+RETRY_DELAY = 1 # 秒
+MAX_RETRY_DELAY = 60
+
+class MatchupMatrix:
+    def __init__(self, repository, odds_cache, picks_limit=PICKS_LIMIT):
+        self.repository = repository
+        self.odds_cache = odds_cache
+        self.picks_limit = picks_limit
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._results = {} # (较小 id, 较大 id) -> solve_1v1 结果；只有后台线程写入
+        self._ids = set() # _results 覆盖的角色 id
+        self._picks = {} # 角色 id -> {"best": [...], "counters": [...]}，每次更新后替换
+        self._dirty = set()
+        self._full = True # 需要完整构建
+        self._busy = False
+        self._thread = None
+        self.version = 0
+        self.updated_at = None
+
+    def _start(self):
+        """Wakes the worker, starting it on first use. Caller holds ``_lock``."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='matchup-matrix', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def invalidate(self, char_ids):
+        """Repository listener: queues the rows/columns of ``char_ids`` for recomputation."""
+        with self._lock:
+            self._dirty.update(char_ids)
+            if self._thread is not None:
+                self._wake.set()
+
+    def _run(self):
+        delay = RETRY_DELAY
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                full, dirty = self._full, self._dirty
+                self._full, self._dirty = False, set()
+                self._busy = True
+            failed = False
+            try:
+                self._update(full, dirty)
+            except Exception as e:
+                print(f"Error: matchup matrix update failed, retrying in {delay} s: {e}")
+                failed = True
+                with self._lock:
+                    self._full = True # 重试时完整重建
+            finally:
+                with self._lock:
+                    self._busy = False
+            if failed:
+                # 不等其他角色修改，退避后自行重试
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                self._wake.set()
+            else:
+                delay = RETRY_DELAY
+
+    def _update(self, full, dirty):
+        characters = self.repository.all()
+        by_id = {c['id']: c for c in characters}
+        ids = sorted(by_id)
+        if full:
+            pairs = [(a, b) for i, a in enumerate(ids) for b in ids[i + 1:]]
+        else:
+            pairs = sorted({(min(a, b), max(a, b)) for a in dirty if a in by_id for b in ids if b != a})
+        results = {pair: self.odds_cache.get(by_id[pair[0]], by_id[pair[1]]) for pair in pairs}
+        if full:
+            with self._lock:
+                self._results = results
+                self._ids = set(ids)
+            picks = self._build_picks(results)
+        else:
+            # 只改动变更角色（含已删除角色）所在的行列
+            removed = self._ids - by_id.keys()
+            changed = (set(dirty) & by_id.keys()) | removed
+            stale = [(min(r, b), max(r, b)) for r in removed for b in self._ids if b != r]
+            with self._lock:
+                for key in stale:
+                    self._results.pop(key, None)
+                self._results.update(results)
+                self._ids = set(ids)
+            picks = self._patch_picks(changed, ids)
+        with self._lock:
+            self._picks = picks
+            self.version += 1
+            self.updated_at = time.time()
+
+    def _top(self, best, counters):
+        """Strongest ``picks_limit`` entries of each list (ties by opponent id)."""
+        return {
+            "best": sorted(best, key=lambda item: (-item[1], item[0]))[:self.picks_limit],
+            "counters": sorted(counters, key=lambda item: (-item[1], item[0]))[:self.picks_limit],
+        }
+
+    def _build_picks(self, results):
+        """Per character: opponents it beats (``best``) and that beat it (``counters``) with p > 0.5."""
+        best = {}
+        counters = {}
+        for (a, b), result in results.items():
+            for winner, loser, p in ((a, b, result['win']), (b, a, result['loss'])):
+                if p > 0.5:
+                    best.setdefault(winner, []).append((loser, p))
+                    counters.setdefault(loser, []).append((winner, p))
+        return {char_id: self._top(best.get(char_id, ()), counters.get(char_id, ()))
+                for char_id in set(best) | set(counters)}
+
+    def _cells(self, char_id, opponents):
+        """(best, counters) candidates of ``char_id`` against ``opponents``. Worker thread only."""
+        best = []
+        counters = []
+        for opponent in opponents:
+            p = self._win_probability(char_id, opponent)
+            if p is None:
+                continue
+            if p > 0.5:
+                best.append((opponent, p))
+            q = self._win_probability(opponent, char_id)
+            if q > 0.5:
+                counters.append((opponent, q))
+        return best, counters
+
+    def _patch_picks(self, changed, ids):
+        """Picks after an incremental update that touched the rows/columns of ``changed``.
+
+        Changed characters get their row recomputed. Any other character
+        whose current picks name a changed opponent is recomputed too (a
+        dropped entry may need its next-best replacement); everyone else just
+        merges the new cells into the lists they already have. Worker thread only.
+        """
+        picks = dict(self._picks)
+        present = [char_id for char_id in changed if char_id in self._ids]
+        for char_id in changed:
+            picks.pop(char_id, None)
+        for char_id in ids:
+            old = picks.get(char_id)
+            if char_id in changed or (old is not None and any(
+                    opponent in changed for opponent, _ in old['best'] + old['counters'])):
+                entry = self._top(*self._cells(char_id, (b for b in ids if b != char_id)))
+            else:
+                best, counters = self._cells(char_id, present)
+                if not best and not counters:
+                    continue
+                if old is not None:
+                    best += old['best']
+                    counters += old['counters']
+                entry = self._top(best, counters)
+            if entry['best'] or entry['counters']:
+                picks[char_id] = entry
+            else:
+                picks.pop(char_id, None)
+        return picks
+
+    def _win_probability(self, a, b):
+        if a == b:
+            return None
+        result = self._results.get((a, b)) if a < b else self._results.get((b, a))
+        if result is None:
+            return None
+        return result['win'] if a < b else result['loss']
+
+    def _oriented(self, a, b):
+        """solve_1v1 result of ``a`` against ``b`` from the stored pair, or None."""
+        if a < b:
+            return self._results.get((a, b))
+        result = self._results.get((b, a))
+        if result is None:
+            return None
+        return dict(result, win=result['loss'], loss=result['win'])
+
+    def row(self, char_id, characters=None):
+        """Odds of ``char_id`` against every other character, in roster order; never waits.
+
+        Each entry is the solve_1v1 result with ``opponent`` added, or only
+        ``opponent`` and None odds for cells not computed yet.
+        """
+        if characters is None:
+            characters = self.repository.all()
+        missing = {"win": None, "loss": None, "draw": None, "expected_turns": None}
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            odds = [dict(self._oriented(char_id, c['id']) or missing, opponent=c['id'])
+                    for c in characters if c['id'] != char_id]
+            pending = self._full or self._busy or bool(self._dirty)
+            version, updated_at = self.version, self.updated_at
+        return {"odds": odds, "pending": pending, "version": version, "updated_at": updated_at}
+
+    def snapshot(self, characters=None):
+        """The current matrix in roster order; never waits for the worker.
+
+        ``matrix[i][j]`` is the probability that ``ids[i]`` beats ``ids[j]``
+        (None on the diagonal and for cells not computed yet).
+        """
+        if characters is None:
+            characters = self.repository.all()
+        ids = [c['id'] for c in characters]
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            matrix = [[self._win_probability(a, b) for b in ids] for a in ids]
+            pending = self._full or self._busy or bool(self._dirty)
+            version, updated_at = self.version, self.updated_at
+        return {
+            "ids": ids,
+            "names": [c['name'] for c in characters],
+            "matrix": matrix,
+            "pending": pending,
+            "version": version,
+            "updated_at": updated_at,
+        }
+
+    def picks(self, characters=None):
+        """Per character id: its ``counters`` (opponents most likely to beat it) and
+        ``best`` (opponents it is most likely to beat), each a list of up to
+        ``picks_limit`` (opponent id, probability) with probability > 0.5,
+        strongest first. Served from the last finished update; never waits.
+        """
+        if characters is None:
+            characters = self.repository.all()
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            picks = self._picks
+        empty = {"best": [], "counters": []}
+        return {c['id']: picks.get(c['id'], empty) for c in characters}
@@ -0,0 +1,159 @@
+"""Exact 1v1 odds, computed instead of sampled.
+
+In a 1v1 each side attacks exactly once per turn while both are alive, and
+what it deals does not depend on the state of the fight: a uniformly chosen
+skill's base damage times a uniform ±15% fluctuation, rounded and floored at
+zero. So the number of attacks fighter A needs to bring B to 0 HP, N_A, is a
+random variable of its own, independent of N_B; the battle ends at turn
+min(N_A, N_B), a tie in the same turn goes to whoever acts first (1/2 each)
+and it is a draw if neither has won after MAX_TURNS turns.
+
+The distribution of N_A is a dynamic programme over B's accumulated damage
+(one state per HP value still alive), so the odds cost
+O(MAX_TURNS × HP × damage values) once per pairing and are memoized by
+OddsCache by the content of both characters.
+"""
+import threading
+
+from fighter import FLUCTUATION, MAX_TURNS
+from matchup_cache import character_hash
+from simulation import compile_matchup
+
+ODDS_CACHE_SIZE = 4096
+
+def damage_distribution(base_damages):
+    """{damage: probability} of one attack choosing uniformly among ``base_damages``.
+
+    Each base damage ``b`` is scaled by a uniform factor in [1 - FLUCTUATION, 1 + FLUCTUATION) and
+    rounded, so integer ``k`` gets the share of that interval that rounds to
+    it. Returns an empty dict if there are no skills (the fighter never attacks).
+    """
+    distribution = {}
+    if not base_damages:
+        return distribution
+    share = 1 / len(base_damages)
+    for base in base_damages:
+        if base <= 0:
+            distribution[0] = distribution.get(0, 0) + share
+            continue
+        low = base * (1 - FLUCTUATION)
+        high = base * (1 + FLUCTUATION)
+        for k in range(round(low), round(high) + 1):
+            width = min(k + 0.5, high) - max(k - 0.5, low)
+            if width > 0:
+                distribution[k] = distribution.get(k, 0) + share * width / (high - low)
+    return distribution
+
+def kill_turns(distribution, hp, max_turns=MAX_TURNS):
+    """P(the ``hp``-th point of damage lands on attack n) for n = 0..max_turns.
+
+    Index 0 is 1 if ``hp`` is already 0 or less. The remaining mass (never
+    within ``max_turns``) is 1 - sum of the list.
+    """
+    probabilities = [0.0] * (max_turns + 1)
+    if hp <= 0:
+        probabilities[0] = 1.0
+        return probabilities
+    items = sorted(distribution.items())
+    alive = {0: 1.0} # 累计伤害 -> 概率，只保留尚未击倒的状态
+    for n in range(1, max_turns + 1):
+        if not alive or not items:
+            break
+        next_alive = {}
+        killed = 0.0
+        for dealt, p in alive.items():
+            for damage, q in items:
+                total = dealt + damage
+                if total >= hp:
+                    killed += p * q
+                else:
+                    next_alive[total] = next_alive.get(total, 0) + p * q
+        probabilities[n] = killed
+        alive = next_alive
+    return probabilities
+
+def solve_1v1(char_a, char_b, max_turns=MAX_TURNS):
+    """Exact outcome probabilities of ``char_a`` vs ``char_b`` under battle.simulate_battle's 1v1 rules.
+
+    Returns win/loss/draw probabilities from ``char_a``'s point of view and
+    the expected number of turns (a draw counts as ``max_turns``; a battle
+    that is over before it starts as 0).
+    """
+    hp, _, _, damage = compile_matchup([char_a], [char_b])
+    hp_a, hp_b = hp
+    if hp_a <= 0 or hp_b <= 0:
+        # 开局即分出胜负（或双方都已倒下，平局）
+        win = 1.0 if hp_a > 0 else 0.0
+        loss = 1.0 if hp_b > 0 else 0.0
+        return {"win": win, "loss": loss, "draw": 1.0 - win - loss, "expected_turns": 0.0}
+    kills_a = kill_turns(damage_distribution([row[1] for row in damage[0]]), hp_b, max_turns)
+    kills_b = kill_turns(damage_distribution([row[0] for row in damage[1]]), hp_a, max_turns)
+
+    win = loss = expected_turns = 0.0
+    survive_a = survive_b = 1.0 # P(N_A > n-1), P(N_B > n-1)
+    for n in range(1, max_turns + 1):
+        pa, pb = kills_a[n], kills_b[n]
+        after_a, after_b = max(0.0, survive_a - pa), max(0.0, survive_b - pb) # 去掉浮点误差造成的负数
+        # 同一回合双方都能击倒对方时，先行动者获胜
+        win += pa * (after_b + pb / 2)
+        loss += pb * (after_a + pa / 2)
+        expected_turns += n * (survive_a * survive_b - after_a * after_b)
+        survive_a, survive_b = after_a, after_b
+    draw = survive_a * survive_b
+    expected_turns += max_turns * draw
+    return {"win": min(1.0, win), "loss": min(1.0, loss), "draw": draw, "expected_turns": expected_turns}
+
+class OddsCache:
+    """Memoized solve_1v1 results keyed by the content hash of both characters.
+
+    Because the key is the characters' content (matchup_cache.character_hash),
+    a caller still holding a dict from before an edit can only ever fill or
+    read the slot of the old stats, never the current one. ``invalidate``
+    (registered as a repository listener) just frees the entries of changed
+    characters. Bounded to ``max_entries``, oldest first.
+    """
+
+    def __init__(self, max_entries=ODDS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results = {} # (哈希_a, 哈希_b) -> (角色 id 对, 结果)
+        self._pairs = {} # 角色 id -> 包含它的键集合
+
+    def get(self, char_a, char_b):
+        key = (character_hash(char_a), character_hash(char_b))
+        with self._lock:
+            entry = self._results.get(key)
+        if entry is not None:
+            return entry[1]
+        result = solve_1v1(char_a, char_b)
+        ids = (char_a['id'], char_b['id'])
+        with self._lock:
+            if len(self._results) >= self.max_entries:
+                self._drop(next(iter(self._results)))
+            self._results[key] = (ids, result)
+            for char_id in ids:
+                self._pairs.setdefault(char_id, set()).add(key)
+        return result
+
+    def _drop(self, key):
+        entry = self._results.pop(key, None)
+        if entry is None:
+            return
+        for char_id in entry[0]:
+            keys = self._pairs.get(char_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._pairs[char_id]
+
+    def invalidate(self, char_ids):
+        """Frees every pairing that involves one of ``char_ids``."""
+        with self._lock:
+            for char_id in char_ids:
+                for key in list(self._pairs.get(char_id, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._pairs.clear()
@@ -0,0 +1,80 @@
+"""Crash-safe JSON persistence shared by the web app, the Tk tool and the ledger.
+
+Writes go to a temporary file in the target directory, are fsynced and then
+renamed over the target, so readers only ever see the old or the new file.
+Writers coordinate through an advisory lock on a sidecar ``<file>.lock``
+that works across processes (flock on POSIX, msvcrt on Windows).
+"""
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+def lock_path_for(path):
+    return path + '.lock'
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Holds an advisory lock for ``path`` (shared when ``exclusive`` is False).
+
+    Windows has no shared flock, so every lock is exclusive there.
+    """
+    lock_path = lock_path_for(path)
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a+') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _fsync_directory(directory):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write_bytes(path, data):
+    """Replaces ``path`` with ``data`` via temp file + fsync + rename."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+def atomic_write_json(path, data, indent=2, ensure_ascii=False):
+    atomic_write_bytes(path, json.dumps(data, indent=indent, ensure_ascii=ensure_ascii).encode('utf-8'))
+
+def truncate(path):
+    """Empties ``path`` (creating it if needed) and makes the change durable."""
+    with open(path, 'wb') as f:
+        f.flush()
+        os.fsync(f.fileno())
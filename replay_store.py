@@ -0,0 +1,132 @@
+"""Persisted battle replays addressed by a short id.
+
+``/battle`` stores every finished battle here and returns its id, and
+``/battle_result/<id>`` reads it back, instead of passing the whole step
+log through the query string. A replay is only the battle.battle_record
+(seed, participants, roster hash); the step list is regenerated with
+battle.replay_battle when someone opens it. Roster snapshots are stored
+once per roster hash under data/replays/rosters and shared by every battle
+fought with that roster.
+
+Files are zlib-compressed JSON; the directory is bounded in total size and
+entries older than ``max_age`` are evicted.
+"""
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import zlib
+
+from persistence import atomic_write_bytes
+
+REPLAY_DIR = 'data/replays'
+MAX_REPLAY_BYTES = 64 * 1024 * 1024
+MAX_REPLAY_AGE = 7 * 24 * 60 * 60 # 秒
+CLEANUP_EVERY = 100 # 每保存多少次完整扫描一次目录
+
+_REPLAY_ID = re.compile(r'^[A-Za-z0-9_-]{6,32}$')
+_ROSTER_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+def _compress(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+
+def _read_compressed(path):
+    with open(path, 'rb') as f:
+        return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+
+class ReplayStore:
+    def __init__(self, directory=REPLAY_DIR, max_bytes=MAX_REPLAY_BYTES, max_age=MAX_REPLAY_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._total_bytes = None # 目录总大小的估计值，首次保存时扫描
+        self._saves = 0
+
+    def _path(self, replay_id):
+        return os.path.join(self.directory, replay_id + '.json.z')
+
+    def _roster_path(self, roster_hash):
+        return os.path.join(self.directory, 'rosters', roster_hash + '.json.z')
+
+    def save(self, record, roster=None):
+        """Stores ``record`` and returns its id.
+
+        ``roster`` (battle.roster_snapshot of the participants) is written once
+        per ``record['roster_hash']``; later battles with the same roster only
+        refresh its timestamp.
+        """
+        written = 0
+        if roster is not None:
+            roster_path = self._roster_path(record['roster_hash'])
+            try:
+                os.utime(roster_path)
+            except FileNotFoundError:
+                roster_data = _compress(roster)
+                atomic_write_bytes(roster_path, roster_data)
+                written += len(roster_data)
+        data = _compress(record)
+        replay_id = secrets.token_urlsafe(8)
+        atomic_write_bytes(self._path(replay_id), data)
+        written += len(data)
+        with self._lock:
+            self._saves += 1
+            if self._total_bytes is None or self._saves % CLEANUP_EVERY == 0:
+                self._cleanup()
+            else:
+                self._total_bytes += written
+                if self._total_bytes > self.max_bytes:
+                    self._cleanup()
+        return replay_id
+
+    def _load(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            return _read_compressed(path)
+        except (FileNotFoundError, zlib.error, ValueError):
+            return None
+
+    def get(self, replay_id):
+        """Returns the stored record, or None if the id is unknown, malformed or expired."""
+        if not replay_id or not _REPLAY_ID.match(replay_id):
+            return None
+        return self._load(self._path(replay_id))
+
+    def get_roster(self, roster_hash):
+        """Returns the roster snapshot stored for ``roster_hash``, or None."""
+        if not roster_hash or not _ROSTER_HASH.match(roster_hash):
+            return None
+        return self._load(self._roster_path(roster_hash))
+
+    def _cleanup(self):
+        """Deletes expired replays, then the oldest ones until under max_bytes."""
+        now = time.time()
+        entries = []
+        for directory in (self.directory, os.path.join(self.directory, 'rosters')):
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if not name.endswith('.json.z'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total_bytes = total
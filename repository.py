@@ -0,0 +1,319 @@
+import copy
+import json
+import os
+import threading
+
+from persistence import atomic_write_json, file_lock
+
+DATA_FILE = 'data/characters.json'
+
+# 存储后端：'json'（默认，data/characters.json）或 'sqlite'（见 sqlite_store.py）
+STORAGE_BACKEND = os.environ.get('FIGHT_CARD_STORAGE', 'json')
+DATABASE_FILE = os.environ.get('FIGHT_CARD_DB', 'data/fight_card.db')
+
+ELEMENTS = ['金', '木', '水', '火', '土', '风', '雷', '毒', '法', '圣', '精神']
+
+def normalize_character(char):
+    """Normalizes skills and attributes of a character in place."""
+    # 确保skills中的damage字段是字典
+    for i, skill_item in enumerate(char.get('skills', [])):
+        if isinstance(skill_item, str):
+            # 如果技能是字符串，转换为字典格式
+            char['skills'][i] = {
+                'name': skill_item,
+                'effect': '', # Add default effect
+                'damage': {element: 0 for element in ELEMENTS}
+            }
+            skill_item = char['skills'][i] # 更新skill_item为新创建的字典
+        # 确保skills中的effect字段存在
+        if 'effect' not in skill_item:
+            skill_item['effect'] = ''
+        # 确保skills中的damage字段是字典
+        if 'damage' not in skill_item or not isinstance(skill_item['damage'], dict):
+            skill_item['damage'] = {element: 0 for element in ELEMENTS}
+        else:
+            # 确保所有元素键都存在于damage字典中
+            for element in ELEMENTS:
+                if element not in skill_item['damage']:
+                    skill_item['damage'][element] = 0
+
+    # Heuristic fix for '精神' damage transfer issue
+    # 确保attributes中的resistance字段是字典
+    for i, attr_item in enumerate(char.get('attributes', [])):
+        if isinstance(attr_item, str):
+            # 如果属性是字符串，转换为字典格式
+            char['attributes'][i] = {
+                'name': attr_item,
+                'resistance': {element: 0 for element in ELEMENTS}
+            }
+            attr_item = char['attributes'][i] # 更新attr_item为新创建的字典
+        # 确保attributes中的resistance字段是字典
+        if 'resistance' not in attr_item or not isinstance(attr_item['resistance'], dict):
+            attr_item['resistance'] = {element: 0 for element in ELEMENTS}
+        else:
+            # 确保所有元素键都存在于resistance字典中
+            for element in ELEMENTS:
+                if element not in attr_item['resistance']:
+                    attr_item['resistance'][element] = 0
+    return char
+
+class CharacterIndex:
+    """id→character lookups over a roster.
+
+    Names are not unique, so there is no name lookup: battle steps identify
+    fighters by their participant ``position`` instead (see battle.battle_events).
+    """
+
+    def __init__(self, characters=()):
+        self._by_id = {}
+        for char in characters:
+            self.add(char)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, char_id):
+        return char_id in self._by_id
+
+    def get(self, char_id, default=None):
+        return self._by_id.get(char_id, default)
+
+    def ids(self):
+        return self._by_id.keys()
+
+    def add(self, char):
+        self._by_id[char['id']] = char
+
+    def replace(self, char):
+        """Swaps in a new dict for an existing id."""
+        self._by_id[char['id']] = char
+
+    def remove(self, char_id):
+        return self._by_id.pop(char_id, None)
+
+class JsonCharacterStore:
+    """Stores the roster in characters.json.
+
+    Every write replaces the file atomically under an advisory lock shared
+    with the Tk tool and other worker processes. Single-character writes
+    re-read the file under that lock, so they never drop another process's
+    concurrent edit, and ``insert_new`` assigns the new id there too.
+    Writes return the store signature from before and after the write,
+    both read under the lock, so a caller can tell whether anyone else
+    wrote since it last loaded.
+    """
+
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+
+    def signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('characters', [])
+
+    def _write(self, characters):
+        atomic_write_json(self.path, {'characters': characters})
+
+    def save_all(self, characters):
+        with file_lock(self.path):
+            before = self.signature()
+            self._write(characters)
+            return before, self.signature()
+
+    def upsert(self, character):
+        with file_lock(self.path):
+            before = self.signature()
+            current = self.load()
+            for i, c in enumerate(current):
+                if c.get('id') == character['id']:
+                    current[i] = character
+                    break
+            else:
+                current.append(character)
+            self._write(current)
+            return before, self.signature()
+
+    def insert_new(self, character):
+        """Appends ``character`` under the id max(id)+1 (set on the dict in place)."""
+        with file_lock(self.path):
+            before = self.signature()
+            current = self.load()
+            character['id'] = max((c['id'] for c in current), default=0) + 1
+            current.append(character)
+            self._write(current)
+            return before, self.signature()
+
+    def delete(self, char_id):
+        with file_lock(self.path):
+            before = self.signature()
+            self._write([c for c in self.load() if c.get('id') != char_id])
+            return before, self.signature()
+
+def create_store():
+    """Returns the character store selected by FIGHT_CARD_STORAGE."""
+    if STORAGE_BACKEND == 'sqlite':
+        from sqlite_store import SqliteCharacterStore
+        return SqliteCharacterStore(DATABASE_FILE)
+    return JsonCharacterStore(DATA_FILE)
+
+class CharacterRepository:
+    """Process-wide, in-memory view of the character store.
+
+    The roster is loaded and normalized once; later reads are served from
+    memory. The cache is reloaded only when the store's signature changes
+    (characters.json mtime/size, or the SQLite version counter), e.g. because
+    the Tk tool saved, or when a write goes through the repository.
+
+    Returned character dicts are shared with the cache and must be treated as
+    read-only; use ``get_copy`` to obtain a dict that can be edited and passed
+    back to ``update``. The id index is maintained incrementally on add,
+    update and delete instead of being rebuilt.
+
+    Listeners registered with ``add_listener`` are called with the ids of
+    characters that were added, changed or removed, whether the change went
+    through the repository or was picked up on reload (e.g. a save in the Tk
+    tool), so derived caches can drop only what is affected.
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else create_store()
+        self._lock = threading.RLock()
+        self._characters = []
+        self._index = CharacterIndex()
+        self._signature = None
+        self._loaded = False
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Calls ``callback(char_ids)`` after characters change. Runs under the repository lock; keep it cheap."""
+        self._listeners.append(callback)
+
+    def _notify(self, char_ids):
+        char_ids = set(char_ids)
+        if not char_ids:
+            return
+        for callback in self._listeners:
+            callback(char_ids)
+
+    def _changed_ids(self, characters):
+        """Ids whose character differs between the current index and ``characters``."""
+        changed = set(self._index.ids()) - {char['id'] for char in characters}
+        for char in characters:
+            if self._index.get(char['id']) != char:
+                changed.add(char['id'])
+        return changed
+
+    def _refresh(self):
+        """Reloads the cache if the backing store changed since the last load."""
+        signature = self.store.signature()
+        if self._loaded and signature == self._signature:
+            return
+        characters = self.store.load()
+        for char in characters:
+            normalize_character(char)
+        # 首次加载不通知：此前没有任何派生数据
+        changed = self._changed_ids(characters) if self._listeners and len(self._index) else ()
+        self._characters = characters
+        self._index = CharacterIndex(characters)
+        self._signature = signature
+        self._loaded = True
+        self._notify(changed)
+
+    def _commit(self, write, characters):
+        """Runs a store write and adopts ``characters`` as the new cache.
+
+        The store reports its signature from just before and after the write,
+        both taken under its lock. If the one before is not the signature we
+        last loaded, another process wrote in between; the cache is then
+        dropped and reloaded lazily instead.
+        """
+        before, signature = write()
+        if before != self._signature:
+            self._loaded = False
+            self._signature = None
+            return False
+        self._characters = characters
+        self._signature = signature
+        self._loaded = True
+        return True
+
+    def all(self):
+        """Returns the cached list of all characters."""
+        with self._lock:
+            self._refresh()
+            return self._characters
+
+    def index(self):
+        """Returns the shared id index of the cached roster."""
+        with self._lock:
+            self._refresh()
+            return self._index
+
+    def get(self, char_id):
+        """Returns the cached character with the given id, or None."""
+        return self.index().get(char_id)
+
+    def get_copy(self, char_id):
+        """Returns an editable deep copy of a character, or None."""
+        character = self.get(char_id)
+        return copy.deepcopy(character) if character is not None else None
+
+    def save_all(self, characters):
+        """Replaces the whole roster."""
+        with self._lock:
+            characters = [normalize_character(char) for char in characters]
+            _, signature = self.store.save_all(characters)
+            changed = self._changed_ids(characters) if self._listeners else ()
+            self._characters = characters
+            self._index = CharacterIndex(characters)
+            self._signature = signature
+            self._loaded = True
+            self._notify(changed)
+
+    def add(self, character):
+        """Stores a new character under a fresh id and returns it.
+
+        The id (max(id)+1) is assigned by the store under its lock, so
+        concurrent creates in other processes never get the same id.
+        """
+        with self._lock:
+            self._refresh()
+            normalize_character(character)
+            characters = self._characters + [character]
+            if self._commit(lambda: self.store.insert_new(character), characters):
+                self._index.add(character)
+            self._notify([character['id']])
+            return character
+
+    def update(self, character):
+        """Replaces the stored character that has the same id."""
+        with self._lock:
+            self._refresh()
+            normalize_character(character)
+            characters = [character if c['id'] == character['id'] else c for c in self._characters]
+            if self._commit(lambda: self.store.upsert(character), characters):
+                self._index.replace(character)
+            self._notify([character['id']])
+            return character
+
+    def delete(self, char_id):
+        """Removes a character and returns the removed dict, or None."""
+        with self._lock:
+            self._refresh()
+            removed = self._index.get(char_id)
+            if removed is not None:
+                characters = [c for c in self._characters if c['id'] != char_id]
+                if self._commit(lambda: self.store.delete(char_id), characters):
+                    self._index.remove(char_id)
+                self._notify([char_id])
+            return removed
+
+repository = CharacterRepository()
@@ -0,0 +1,192 @@
+"""Headless batch battle simulation.
+
+Runs many seeded battles for one matchup with the same rules as
+``battle.simulate_battle`` (random turn order, uniform skill and defender
+choice, ±15% fluctuation, MAX_TURNS) but without building a step log or
+touching win_rates.json. Intended for balance testing.
+"""
+import math
+import random
+
+from damage import DamageMatrix
+from fighter import FLUCTUATION, MAX_TURNS
+
+# 波动系数 = FLUCTUATION_BASE + FLUCTUATION_WIDTH * r，即 [1 - FLUCTUATION, 1 + FLUCTUATION)
+FLUCTUATION_BASE = 1 - FLUCTUATION
+FLUCTUATION_WIDTH = 2 * FLUCTUATION
+
+def compile_matchup(team1, team2, matrix=None):
+    """Compiles two teams into the flat tables used by the batch loops.
+
+    Returns ``(hp, team_of, members, damage)`` where fighters are numbered
+    team1 first, ``members[t]`` lists the fighters of team ``t`` in team
+    order and ``damage[a][s][d]`` is the base damage of skill ``s`` of
+    fighter ``a`` against fighter ``d``. ``matrix`` may be a roster-wide
+    DamageMatrix that already contains every fighter, so repeated matchups
+    over the same roster share its memoized base damage.
+    """
+    fighters = list(team1) + list(team2)
+    if matrix is None:
+        matrix = DamageMatrix(fighters, eager=True)
+    positions = [matrix.position(char) for char in fighters]
+    hp = [char['stats']['hp'] for char in fighters]
+    team_of = [0] * len(team1) + [1] * len(team2)
+    members = [list(range(len(team1))), list(range(len(team1), len(fighters)))]
+    damage = [
+        [[matrix.get(a, s, d) for d in positions] for s in range(len(matrix.skill_items[a]))]
+        for a in positions
+    ]
+    return hp, team_of, members, damage
+
+def _run_1v1(rng, hp, damage, dealt):
+    """One 1v1 battle. Returns (winner_team or None, turns)."""
+    rand = rng.random
+    hp0, hp1 = hp
+    skills0 = [row[1] for row in damage[0]]
+    skills1 = [row[0] for row in damage[1]]
+    n0, n1 = len(skills0), len(skills1)
+    dealt0 = dealt1 = 0
+    turn = 1
+    if hp0 > 0 and hp1 > 0:
+        while turn <= MAX_TURNS:
+            first = 0 if rand() < 0.5 else 1
+            for attacker in (first, 1 - first):
+                if attacker == 0:
+                    if not n0:
+                        continue
+                    base = skills0[int(rand() * n0)] if n0 > 1 else skills0[0]
+                    dmg = round(base * (FLUCTUATION_BASE + FLUCTUATION_WIDTH * rand()))
+                    if dmg < 0:
+                        dmg = 0
+                    dealt0 += dmg
+                    hp1 -= dmg
+                    if hp1 <= 0:
+                        dealt[0] = dealt0
+                        dealt[1] = dealt1
+                        return 0, turn
+                else:
+                    if not n1:
+                        continue
+                    base = skills1[int(rand() * n1)] if n1 > 1 else skills1[0]
+                    dmg = round(base * (FLUCTUATION_BASE + FLUCTUATION_WIDTH * rand()))
+                    if dmg < 0:
+                        dmg = 0
+                    dealt1 += dmg
+                    hp0 -= dmg
+                    if hp0 <= 0:
+                        dealt[0] = dealt0
+                        dealt[1] = dealt1
+                        return 1, turn
+            turn += 1
+    dealt[0] = dealt0
+    dealt[1] = dealt1
+    if hp0 > 0 and hp1 <= 0:
+        return 0, 0
+    if hp1 > 0 and hp0 <= 0:
+        return 1, 0
+    return None, (MAX_TURNS if hp0 > 0 else 0)
+
+def _run_teams(rng, hp_start, team_of, members, damage, dealt):
+    """One battle between two teams of any size. Returns (winner_team or None, turns)."""
+    rand = rng.random
+    hp = list(hp_start)
+    alive = [sum(1 for i in team if hp[i] > 0) for team in members]
+    fighters = range(len(hp))
+    for i in fighters:
+        dealt[i] = 0
+    turn = 1
+    while alive[0] and alive[1] and turn <= MAX_TURNS:
+        order = [i for i in fighters if hp[i] > 0]
+        rng.shuffle(order)
+        for attacker in order:
+            if hp[attacker] <= 0:
+                continue
+            opponent_team = 1 - team_of[attacker]
+            opponents = [i for i in members[opponent_team] if hp[i] > 0]
+            if not opponents:
+                break
+            skills = damage[attacker]
+            if not skills:
+                continue
+            row = skills[int(rand() * len(skills))]
+            defender = opponents[int(rand() * len(opponents))]
+            dmg = round(row[defender] * (FLUCTUATION_BASE + FLUCTUATION_WIDTH * rand()))
+            if dmg < 0:
+                dmg = 0
+            dealt[attacker] += dmg
+            hp[defender] -= dmg
+            if hp[defender] <= 0:
+                alive[opponent_team] -= 1
+                if not alive[opponent_team]:
+                    return 1 - opponent_team, turn
+        turn += 1
+    if alive[0] and alive[1]:
+        return None, MAX_TURNS
+    if alive[0]:
+        return 0, turn - 1
+    if alive[1]:
+        return 1, turn - 1
+    return None, turn - 1
+
+def simulate_matchup(team1, team2, battles=1000, seed=None, matrix=None):
+    """Runs ``battles`` seeded battles between two teams and aggregates the outcomes.
+
+    No step log is built and nothing is written to disk. Returns a dict with
+    win/loss/draw counts from team1's point of view, mean turns, a turn-count
+    histogram and per-character damage-dealt statistics (mean, stdev, min,
+    max), keyed by character id. ``seed`` may be any value accepted by
+    ``random.Random``; ``matrix`` is passed through to compile_matchup.
+    """
+    rng = random.Random(seed)
+    hp, team_of, members, damage = compile_matchup(team1, team2, matrix)
+    run = _run_1v1 if len(team1) == 1 and len(team2) == 1 else None
+    fighters = list(team1) + list(team2)
+    count = len(fighters)
+    dealt = [0] * count
+    dmg_sum = [0] * count
+    dmg_sq = [0] * count
+    dmg_min = [math.inf] * count
+    dmg_max = [0] * count
+    outcomes = [0, 0, 0] # team1 胜, team2 胜, 平局
+    turns_histogram = {}
+    total_turns = 0
+
+    for _ in range(battles):
+        if run is not None:
+            winner, turns = run(rng, hp, damage, dealt)
+        else:
+            winner, turns = _run_teams(rng, hp, team_of, members, damage, dealt)
+        outcomes[2 if winner is None else winner] += 1
+        total_turns += turns
+        turns_histogram[turns] = turns_histogram.get(turns, 0) + 1
+        for i in range(count):
+            value = dealt[i]
+            dmg_sum[i] += value
+            dmg_sq[i] += value * value
+            if value < dmg_min[i]:
+                dmg_min[i] = value
+            if value > dmg_max[i]:
+                dmg_max[i] = value
+
+    damage_stats = {}
+    for i, char in enumerate(fighters):
+        mean = dmg_sum[i] / battles if battles else 0
+        variance = dmg_sq[i] / battles - mean * mean if battles else 0
+        damage_stats[char['id']] = {
+            "team": team_of[i] + 1,
+            "mean": mean,
+            "stdev": math.sqrt(max(0, variance)),
+            "min": dmg_min[i] if battles else 0,
+            "max": dmg_max[i],
+        }
+
+    return {
+        "battles": battles,
+        "wins": outcomes[0],
+        "losses": outcomes[1],
+        "draws": outcomes[2],
+        "win_rate": outcomes[0] / battles if battles else 0,
+        "mean_turns": total_turns / battles if battles else 0,
+        "turns_histogram": dict(sorted(turns_histogram.items())),
+        "damage_dealt": damage_stats,
+    }
@@ -0,0 +1,242 @@
+"""Optional SQLite storage backend.
+
+Enabled with ``FIGHT_CARD_STORAGE=sqlite`` (database path in
+``FIGHT_CARD_DB``, default data/fight_card.db). Characters, skills,
+attributes and win rates live in normalized tables, the database runs in WAL
+mode, and editing one character rewrites only that character's rows instead
+of the whole dataset.
+
+Existing JSON data is imported once with::
+
+    python sqlite_store.py migrate [characters.json] [win_rates.json]
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS characters (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    hp INTEGER NOT NULL DEFAULT 0,
+    image TEXT NOT NULL DEFAULT '',
+    audio TEXT NOT NULL DEFAULT '',
+    element TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS skills (
+    character_id INTEGER NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    effect TEXT NOT NULL DEFAULT '',
+    damage TEXT NOT NULL DEFAULT '{}',
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (character_id, position)
+);
+CREATE TABLE IF NOT EXISTS attributes (
+    character_id INTEGER NOT NULL REFERENCES characters(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    resistance TEXT NOT NULL DEFAULT '{}',
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (character_id, position)
+);
+CREATE TABLE IF NOT EXISTS win_rates (
+    character_id TEXT PRIMARY KEY,
+    total_battles INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_characters_name ON characters(name);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('characters_version', 0);
+"""
+
+CHARACTER_COLUMNS = ('id', 'name', 'image', 'audio', 'element')
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+class SqliteDatabase:
+    """One SQLite file with a connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+class SqliteCharacterStore:
+    """Character storage with the same surface as repository.JsonCharacterStore."""
+
+    def __init__(self, database):
+        self.db = database if isinstance(database, SqliteDatabase) else SqliteDatabase(database)
+
+    def signature(self, conn=None):
+        """Changes whenever any process commits a character write."""
+        conn = conn or self.db.connection()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'characters_version'").fetchone()
+        return row[0] if row else None
+
+    def _bump_version(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'characters_version'")
+
+    def load(self):
+        conn = self.db.connection()
+        skills = {}
+        for row in conn.execute('SELECT * FROM skills ORDER BY character_id, position'):
+            skill = {'name': row['name'], 'effect': row['effect'], 'damage': json.loads(row['damage'])}
+            skill.update(json.loads(row['extra']))
+            skills.setdefault(row['character_id'], []).append(skill)
+        attributes = {}
+        for row in conn.execute('SELECT * FROM attributes ORDER BY character_id, position'):
+            attribute = {'name': row['name'], 'resistance': json.loads(row['resistance'])}
+            attribute.update(json.loads(row['extra']))
+            attributes.setdefault(row['character_id'], []).append(attribute)
+        characters = []
+        for row in conn.execute('SELECT * FROM characters ORDER BY id'):
+            char = {
+                'id': row['id'],
+                'name': row['name'],
+                'stats': {'hp': row['hp']},
+                'skills': skills.get(row['id'], []),
+                'image': row['image'],
+                'audio': row['audio'],
+                'attributes': attributes.get(row['id'], []),
+                'element': row['element'],
+            }
+            char.update(json.loads(row['extra']))
+            characters.append(char)
+        return characters
+
+    def _write_character(self, conn, char):
+        stats = char.get('stats') or {}
+        extra = {k: v for k, v in char.items() if k not in CHARACTER_COLUMNS + ('stats', 'skills', 'attributes')}
+        if set(stats) - {'hp'}:
+            extra['stats'] = stats
+        conn.execute(
+            'INSERT INTO characters (id, name, hp, image, audio, element, extra) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET name = excluded.name, hp = excluded.hp, image = excluded.image, '
+            'audio = excluded.audio, element = excluded.element, extra = excluded.extra',
+            (char['id'], char.get('name', ''), stats.get('hp', 0), char.get('image', ''),
+             char.get('audio', ''), char.get('element', ''), _dumps(extra)))
+        conn.execute('DELETE FROM skills WHERE character_id = ?', (char['id'],))
+        conn.execute('DELETE FROM attributes WHERE character_id = ?', (char['id'],))
+        conn.executemany(
+            'INSERT INTO skills (character_id, position, name, effect, damage, extra) VALUES (?, ?, ?, ?, ?, ?)',
+            [(char['id'], i, skill.get('name', ''), skill.get('effect', ''), _dumps(skill.get('damage') or {}),
+              _dumps({k: v for k, v in skill.items() if k not in ('name', 'effect', 'damage')}))
+             for i, skill in enumerate(char.get('skills') or [])])
+        conn.executemany(
+            'INSERT INTO attributes (character_id, position, name, resistance, extra) VALUES (?, ?, ?, ?, ?)',
+            [(char['id'], i, attr.get('name', ''), _dumps(attr.get('resistance') or {}),
+              _dumps({k: v for k, v in attr.items() if k not in ('name', 'resistance')}))
+             for i, attr in enumerate(char.get('attributes') or [])])
+
+    # 写操作与 JsonCharacterStore 一样返回写入前后的版本号（在同一事务内读取）
+
+    def save_all(self, characters):
+        with self.db.transaction() as conn:
+            before = self.signature(conn)
+            conn.execute('DELETE FROM characters')
+            for char in characters:
+                self._write_character(conn, char)
+            self._bump_version(conn)
+            return before, self.signature(conn)
+
+    def upsert(self, character):
+        """Writes one character's rows."""
+        with self.db.transaction() as conn:
+            before = self.signature(conn)
+            self._write_character(conn, character)
+            self._bump_version(conn)
+            return before, self.signature(conn)
+
+    def insert_new(self, character):
+        """Inserts ``character`` under the id max(id)+1 (set on the dict in place)."""
+        with self.db.transaction() as conn:
+            before = self.signature(conn)
+            character['id'] = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM characters').fetchone()[0]
+            self._write_character(conn, character)
+            self._bump_version(conn)
+            return before, self.signature(conn)
+
+    def delete(self, char_id):
+        with self.db.transaction() as conn:
+            before = self.signature(conn)
+            conn.execute('DELETE FROM characters WHERE id = ?', (char_id,))
+            self._bump_version(conn)
+            return before, self.signature(conn)
+
+class SqliteWinRateStore:
+    """Win-rate storage with the same surface as win_rate_ledger.WinRateLedger."""
+
+    def __init__(self, database):
+        self.db = database if isinstance(database, SqliteDatabase) else SqliteDatabase(database)
+
+    def load(self):
+        rows = self.db.connection().execute('SELECT character_id, total_battles, wins FROM win_rates')
+        return {row['character_id']: {"total_battles": row['total_battles'], "wins": row['wins']} for row in rows}
+
+    def record(self, winner_ids=(), loser_ids=()):
+        upsert = ('INSERT INTO win_rates (character_id, total_battles, wins) VALUES (?, 1, ?) '
+                  'ON CONFLICT(character_id) DO UPDATE SET total_battles = total_battles + 1, wins = wins + excluded.wins')
+        with self.db.transaction() as conn:
+            conn.executemany(upsert, [(str(i), 1) for i in winner_ids] + [(str(i), 0) for i in loser_ids])
+
+    def replace(self, win_rates):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM win_rates')
+            conn.executemany(
+                'INSERT INTO win_rates (character_id, total_battles, wins) VALUES (?, ?, ?)',
+                [(str(i), r.get('total_battles', 0), r.get('wins', 0)) for i, r in win_rates.items()])
+
+    def flush(self):
+        pass # 每次 record 都已提交
+
+def migrate_from_json(db_path, characters_path='data/characters.json', win_rates_path='data/win_rates.json'):
+    """One-shot import of the JSON files (including the win-rate log) into a SQLite database."""
+    from repository import JsonCharacterStore, normalize_character
+    from win_rate_ledger import WinRateLedger
+
+    database = SqliteDatabase(db_path)
+    characters = [normalize_character(char) for char in JsonCharacterStore(characters_path).load()]
+    SqliteCharacterStore(database).save_all(characters)
+    win_rates = WinRateLedger(win_rates_path).load()
+    SqliteWinRateStore(database).replace(win_rates)
+    return len(characters), len(win_rates)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print(__doc__)
+        sys.exit(1)
+    db_path = os.environ.get('FIGHT_CARD_DB', 'data/fight_card.db')
+    count, rates = migrate_from_json(db_path, *sys.argv[2:4])
+    print(f"已迁移 {count} 个角色、{rates} 条胜率记录到 {db_path}")
@@ -0,0 +1,168 @@
+"""Compact encoding of battle step logs (``/battle?format=compact``).
+
+The default response repeats attacker/defender names and a pre-formatted
+message in every step. The compact form sends a character table and a skill
+table once, numbers characters, skills and event types, and stores the steps
+as parallel columns. Clients rebuild the step dicts (including ``message``)
+from ``templates``; see ``decode_compact``.
+
+Columns (one entry per step between ``start`` and ``end``):
+    e  event type index into ``event_types``
+    t  turn number the step belongs to
+    a  acting character (``character`` / ``attacker``), -1 if none
+    d  defender, -1 if none
+       (both are positions in ``characters``, taken from the steps'
+       ``position`` / ``defender_position``, so fighters that share a name
+       stay apart)
+    s  skill index into ``skills``, -1 if none
+    v  damage dealt (deal_damage), otherwise 0
+    h  hp after the step (deal_damage / hp_update), otherwise 0
+"""
+
+FORMAT_VERSION = 1
+
+EVENT_TYPES = ['turn_start', 'character_turn', 'skip_turn', 'no_skill', 'use_skill', 'deal_damage', 'hp_update', 'defeated']
+
+# {a} 行动角色 {d} 防御者 {s} 技能 {v} 伤害 {t} 回合 {h} 生命值（保留两位小数）
+TEMPLATES = {
+    'turn_start': '--- 第 {t} 回合 ---',
+    'character_turn': '「{a}」的回合。',
+    'skip_turn': '「{a}」已被击败，跳过回合。',
+    'no_skill': '「{a}」没有技能，跳过回合。',
+    'use_skill': '「{a}」对「{d}」使用了「{s}」！',
+    'deal_damage': '「{d}」受到了 {v} 点伤害。',
+    'hp_update': '「{a}」剩余生命值: {h}',
+    'defeated': '「{a}」已被击败！',
+}
+
+_EVENT_IDS = {event: i for i, event in enumerate(EVENT_TYPES)}
+
+# 服务端生成 message 用的格式化函数，与 TEMPLATES 逐条对应（f-string 比 str.format 快）
+_FORMATTERS = {
+    'turn_start': lambda step: f"--- 第 {step['turn']} 回合 ---",
+    'character_turn': lambda step: f"「{step['character']}」的回合。",
+    'skip_turn': lambda step: f"「{step['character']}」已被击败，跳过回合。",
+    'no_skill': lambda step: f"「{step['character']}」没有技能，跳过回合。",
+    'use_skill': lambda step: f"「{step['character']}」对「{step['defender']}」使用了「{step['skill']}」！",
+    'deal_damage': lambda step: f"「{step['defender']}」受到了 {step['damage_dealt']} 点伤害。",
+    'hp_update': lambda step: f"「{step['character']}」剩余生命值: {step['hp']:.2f}",
+    'defeated': lambda step: f"「{step['character']}」已被击败！",
+}
+
+def format_message(step):
+    """Formats the ``message`` of a per-turn engine step (same text as TEMPLATES).
+
+    The battle engine leaves it to the sinks that need the text (see
+    battle.collect_steps); start and end steps carry their own message.
+    """
+    return _FORMATTERS[step['event']](step)
+
+def encode_compact(steps, result, participants):
+    """Encodes a step list produced by battle.simulate_battle* for ``participants``."""
+    characters = []
+    positions = {} # 名字 -> 序号，仅用于没有 position 字段的旧步骤
+    for char in participants:
+        positions.setdefault(char['name'], len(characters))
+        characters.append({
+            'id': char['id'],
+            'name': char['name'],
+            'hp': char['stats']['hp'],
+            'image': char.get('image', ''),
+        })
+
+    skills = []
+    skill_ids = {}
+    columns = {key: [] for key in ('e', 't', 'a', 'd', 's', 'v', 'h')}
+    start = None
+    end = None
+    turn = 0
+
+    for step in steps:
+        event = step['event']
+        if event == 'start':
+            start = {key: value for key, value in step.items() if key != 'characters'}
+            continue
+        if event == 'end':
+            end = step
+            continue
+        if event == 'turn_start':
+            turn = step['turn']
+        actor = step.get('position')
+        if actor is None:
+            name = step.get('character', step.get('attacker'))
+            actor = positions.get(name, -1) if name is not None else -1
+        defender = step.get('defender_position')
+        if defender is None:
+            defender = positions.get(step['defender'], -1) if 'defender' in step else -1
+        skill_id = -1
+        if event == 'use_skill':
+            key = (actor, step['skill'], step['effect'], step.get('audio', ''))
+            skill_id = skill_ids.get(key)
+            if skill_id is None:
+                skill_id = skill_ids[key] = len(skills)
+                skills.append({
+                    'character': actor,
+                    'name': step['skill'],
+                    'effect': step['effect'],
+                    'audio': step.get('audio', ''),
+                })
+        elif event == 'deal_damage':
+            # 伤害事件的技能沿用上一条 use_skill
+            skill_id = columns['s'][-1] if columns['s'] else -1
+        columns['e'].append(_EVENT_IDS[event])
+        columns['t'].append(turn)
+        columns['a'].append(actor)
+        columns['d'].append(defender)
+        columns['s'].append(skill_id)
+        columns['v'].append(step.get('damage_dealt', 0))
+        columns['h'].append(step.get('hp', step.get('defender_hp_after', 0)))
+
+    return {
+        'format': 'compact',
+        'version': FORMAT_VERSION,
+        'event_types': EVENT_TYPES,
+        'templates': TEMPLATES,
+        'characters': characters,
+        'skills': skills,
+        'start': start,
+        'columns': columns,
+        'end': end,
+        'result': result,
+    }
+
+def decode_compact(payload):
+    """Rebuilds the verbose step list from ``encode_compact`` output."""
+    characters = payload['characters']
+    skills = payload['skills']
+    templates = payload['templates']
+    event_types = payload['event_types']
+    columns = payload['columns']
+    hp = [char['hp'] for char in characters]
+    steps = [payload['start']] if payload.get('start') else []
+
+    def name(position):
+        return characters[position]['name'] if position >= 0 else ''
+
+    for e, t, a, d, s, v, h in zip(*(columns[key] for key in ('e', 't', 'a', 'd', 's', 'v', 'h'))):
+        event = event_types[e]
+        skill = skills[s] if s >= 0 else None
+        message = templates[event].format(
+            a=name(a), d=name(d), s=skill['name'] if skill else '', v=v, t=t, h=f"{h:.2f}")
+        if event == 'turn_start':
+            step = {'event': event, 'turn': t}
+        elif event == 'use_skill':
+            step = {'event': event, 'character': name(a), 'defender': name(d), 'position': a, 'defender_position': d,
+                    'skill': skill['name'], 'effect': skill['effect'], 'audio': skill['audio']}
+        elif event == 'deal_damage':
+            step = {'event': event, 'attacker': name(a), 'defender': name(d), 'position': a, 'defender_position': d,
+                    'skill': skill['name'], 'damage_dealt': v, 'defender_hp_before': hp[d], 'defender_hp_after': h}
+            hp[d] = h
+        elif event == 'hp_update':
+            step = {'event': event, 'character': name(a), 'position': a, 'hp': h}
+        else:
+            step = {'event': event, 'character': name(a), 'position': a}
+        step['message'] = message
+        steps.append(step)
+    if payload.get('end'):
+        steps.append(payload['end'])
+    return steps
@@ -0,0 +1,33 @@
+import copy
+
+import simulation
+from matchup_cache import MatchupCache
+
+def _character(char_id):
+    return {'id': char_id, 'name': f'角色{char_id}', 'stats': {'hp': 60}, 'image': '',
+            'skills': [{'name': '撞击', 'effect': '', 'damage': {'金': 12}}],
+            'attributes': [{'name': '甲', 'resistance': {'金': 2}}]}
+
+def _identical_pair():
+    """Two characters whose numbers are identical (ids 9 and 10) and an opponent (id 1)."""
+    twin = _character(9)
+    other_twin = copy.deepcopy(twin)
+    other_twin['id'] = 10
+    return twin, other_twin, _character(1)
+
+def test_identical_characters_get_their_own_entries():
+    twin, other_twin, opponent = _identical_pair()
+    cache = MatchupCache(directory=None)
+    first = cache.get_or_simulate([twin], [opponent], 50, 0, 'python', simulation.simulate_matchup)
+    second = cache.get_or_simulate([other_twin], [opponent], 50, 0, 'python', simulation.simulate_matchup)
+    assert set(first['damage_dealt']) == {'9', '1'}
+    assert set(second['damage_dealt']) == {'10', '1'}
+
+def test_spilled_entries_match_memory_entries(tmp_path):
+    twin, other_twin, opponent = _identical_pair()
+    cache = MatchupCache(directory=str(tmp_path), max_entries=1)
+    first = cache.get_or_simulate([twin], [opponent], 50, 0, 'python', simulation.simulate_matchup)
+    cache.get_or_simulate([other_twin], [opponent], 50, 0, 'python', simulation.simulate_matchup) # 把第一条挤到磁盘
+    reloaded = MatchupCache(directory=str(tmp_path)).get([twin], [opponent], 50, 0, 'python')
+    assert reloaded == first
+    assert set(reloaded['damage_dealt']) == {'9', '1'}
@@ -0,0 +1,50 @@
+import random
+
+from matchup_matrix import MatchupMatrix
+
+class _Repository:
+    def __init__(self, characters):
+        self.characters = characters
+
+    def all(self):
+        return list(self.characters)
+
+class _Odds:
+    """Deterministic fake solve_1v1 keyed by (id, version) of both characters."""
+
+    def get(self, char_a, char_b):
+        rng = random.Random(f"{char_a['id']}:{char_a['v']}:{char_b['id']}:{char_b['v']}")
+        win = rng.choice([0.1, 0.3, 0.5, 0.6, 0.8, 0.9])
+        draw = rng.choice([0.0, 0.05])
+        loss = max(0.0, 1 - win - draw)
+        return {"win": win, "loss": loss, "draw": draw, "expected_turns": 3.0}
+
+def _full_build(characters):
+    matrix = MatchupMatrix(_Repository(characters), _Odds())
+    matrix._update(True, set())
+    return matrix
+
+def test_incremental_updates_match_a_full_rebuild():
+    rng = random.Random(7)
+    characters = [{'id': i, 'v': 0} for i in range(1, 16)]
+    repository = _Repository(characters)
+    matrix = MatchupMatrix(repository, _Odds())
+    matrix._update(True, set())
+    next_id = 16
+    for _ in range(60):
+        action = rng.random()
+        if action < 0.6:
+            char = rng.choice(repository.characters)
+            char['v'] += 1
+            dirty = {char['id']}
+        elif action < 0.8 and len(repository.characters) > 3:
+            char = repository.characters.pop(rng.randrange(len(repository.characters)))
+            dirty = {char['id']}
+        else:
+            repository.characters.append({'id': next_id, 'v': 0})
+            dirty = {next_id}
+            next_id += 1
+        matrix._update(False, dirty)
+        expected = _full_build(repository.characters)
+        assert matrix._results == expected._results
+        assert matrix._picks == expected._picks
@@ -0,0 +1,22 @@
+import copy
+
+import pytest
+
+import battle
+from step_codec import decode_compact, encode_compact
+
+def _mirror(char_id, hp, damage):
+    """A character named like every other one, so only its position tells it apart."""
+    return {'id': char_id, 'name': '镜像', 'stats': {'hp': hp}, 'image': '',
+            'skills': [{'name': '撞击', 'effect': '', 'damage': {'金': damage}},
+                       {'name': '猛击', 'effect': '', 'damage': {'金': damage * 2}}],
+            'attributes': [{'name': '甲', 'resistance': {'金': 1}}]}
+
+@pytest.mark.parametrize('seed', range(50))
+@pytest.mark.parametrize('battle_mode, team1, team2', [
+    ('1v1', [_mirror(1, 60, 7)], [_mirror(2, 50, 9)]),
+    ('2v2', [_mirror(1, 60, 7), _mirror(2, 50, 9)], [_mirror(3, 55, 8), _mirror(4, 45, 10)]),
+])
+def test_same_named_characters_round_trip(battle_mode, team1, team2, seed):
+    steps, result = battle.simulate_battle(team1, team2, battle_mode=battle_mode, seed=seed, record_result=False)
+    assert decode_compact(encode_compact(copy.deepcopy(steps), result, team1 + team2)) == steps
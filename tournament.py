@@ -0,0 +1,214 @@
+"""Round-robin tournaments over the whole roster.
+
+Every 1v1 (or 2v2) pairing in characters.json is simulated with the batch
+engine in simulation.py. Pairings are split into chunks and run on a
+ProcessPoolExecutor; each worker receives the roster once through the pool
+initializer and compiles it into a single DamageMatrix that all of its tasks
+share. Every pairing gets its own seed derived from the master seed and the
+pairing itself, so results do not depend on the number of workers or the
+chunk size.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import battle
+import lockstep
+import simulation
+from damage import DamageMatrix
+
+_ROSTER = None # 进程内的 (id→角色, DamageMatrix)，由 _init_worker 设置
+
+def battle_matchup(team1, team2, battles=1000, seed=None, matrix=None):
+    """simulate_matchup on the real battle engine, for validating the batch engines.
+
+    Each battle runs battle.iter_battle (the loop behind simulate_battle) with
+    its own seed drawn from ``seed``, without a step log and without recording
+    win rates. Returns the same dict as simulation.simulate_matchup;
+    ``matrix`` is ignored.
+    """
+    rng = random.Random(seed)
+    battle_mode = f"{len(team1)}v{len(team2)}"
+    team1_ids = [c['id'] for c in team1]
+    fighters = list(team1) + list(team2)
+    dealt = [[] for _ in fighters]
+    outcomes = [0, 0, 0] # team1 胜, team2 胜, 平局
+    turns_histogram = {}
+    total_turns = 0
+    for _ in range(battles):
+        end = battle.battle_outcome(battle.iter_battle(
+            team1, team2, battle_mode, seed=rng.getrandbits(63), record_result=False, log=False))
+        winners = end["winners"]
+        outcomes[2 if not winners else 0 if winners == team1_ids else 1] += 1
+        total_turns += end["turns"]
+        turns_histogram[end["turns"]] = turns_histogram.get(end["turns"], 0) + 1
+        for i, stats in enumerate(end["character_stats"]):
+            dealt[i].append(stats["damage_dealt"])
+
+    damage_stats = {}
+    for i, char in enumerate(fighters):
+        values = dealt[i]
+        mean = sum(values) / battles if battles else 0
+        variance = sum(v * v for v in values) / battles - mean * mean if battles else 0
+        damage_stats[char['id']] = {
+            "team": 1 if i < len(team1) else 2,
+            "mean": mean,
+            "stdev": math.sqrt(max(0, variance)),
+            "min": min(values) if values else 0,
+            "max": max(values) if values else 0,
+        }
+    return {
+        "battles": battles,
+        "wins": outcomes[0],
+        "losses": outcomes[1],
+        "draws": outcomes[2],
+        "win_rate": outcomes[0] / battles if battles else 0,
+        "mean_turns": total_turns / battles if battles else 0,
+        "turns_histogram": dict(sorted(turns_histogram.items())),
+        "damage_dealt": damage_stats,
+    }
+
+ENGINES = {
+    'python': simulation.simulate_matchup,
+    'lockstep': lockstep.simulate_matchup, # 需要 NumPy
+    'battle': battle_matchup, # 完整对战引擎，最慢，用于校验
+}
+
+def _init_worker(characters):
+    global _ROSTER
+    _ROSTER = ({c['id']: c for c in characters}, DamageMatrix(characters, eager=False))
+
+def pairings(char_ids, mode='1v1'):
+    """Yields every (team1_ids, team2_ids) pairing of the roster in a stable order."""
+    char_ids = sorted(char_ids)
+    if mode == '1v1':
+        for a, b in itertools.combinations(char_ids, 2):
+            yield (a,), (b,)
+    elif mode == '2v2':
+        teams = list(itertools.combinations(char_ids, 2))
+        for t1, t2 in itertools.combinations(teams, 2):
+            if not set(t1) & set(t2):
+                yield t1, t2
+    else:
+        raise ValueError(f"Unsupported tournament mode: {mode}")
+
+def pairing_seed(master_seed, team1_ids, team2_ids):
+    """Seed for one pairing; independent of how pairings are chunked."""
+    return f"{master_seed}:{','.join(map(str, team1_ids))}:{','.join(map(str, team2_ids))}"
+
+def _run_chunk(chunk, battles, master_seed, engine='python'):
+    by_id, matrix = _ROSTER
+    simulate_matchup = ENGINES[engine]
+    results = []
+    for team1_ids, team2_ids in chunk:
+        stats = simulate_matchup(
+            [by_id[i] for i in team1_ids], [by_id[i] for i in team2_ids],
+            battles, seed=pairing_seed(master_seed, team1_ids, team2_ids), matrix=matrix)
+        results.append({
+            "team1": list(team1_ids),
+            "team2": list(team2_ids),
+            "wins": stats["wins"],
+            "losses": stats["losses"],
+            "draws": stats["draws"],
+            "mean_turns": stats["mean_turns"],
+        })
+    return results
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _empty_record():
+    return {"wins": 0, "losses": 0, "draws": 0, "battles": 0}
+
+def _credit(record, wins, losses, draws):
+    record["wins"] += wins
+    record["losses"] += losses
+    record["draws"] += draws
+    record["battles"] += wins + losses + draws
+
+def merge_results(results):
+    """Builds per-character standings and a head-to-head matrix from pairing results.
+
+    For 2v2 every member of a team is credited against every member of the
+    opposing team.
+    """
+    head_to_head = {}
+    standings = {}
+    for result in results:
+        wins, losses, draws = result["wins"], result["losses"], result["draws"]
+        for a in result["team1"]:
+            _credit(standings.setdefault(a, _empty_record()), wins, losses, draws)
+            for b in result["team2"]:
+                _credit(head_to_head.setdefault(a, {}).setdefault(b, _empty_record()), wins, losses, draws)
+                _credit(head_to_head.setdefault(b, {}).setdefault(a, _empty_record()), losses, wins, draws)
+        for b in result["team2"]:
+            _credit(standings.setdefault(b, _empty_record()), losses, wins, draws)
+    return head_to_head, standings
+
+def run_tournament(characters, mode='1v1', battles=1000, seed=0, workers=None, chunk_size=64, engine='python'):
+    """Simulates every pairing of ``characters`` and returns the merged results.
+
+    ``workers=1`` runs in-process without a pool. Output is identical for a
+    given ``seed`` regardless of ``workers`` and ``chunk_size``. ``engine``
+    picks the batch simulator ('python', the NumPy 'lockstep' engine, or
+    'battle', the real battle engine for validation runs; their results
+    agree in distribution, not battle for battle).
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown simulation engine: {engine}")
+    if engine == 'lockstep' and not lockstep.available():
+        raise ValueError("The lockstep engine requires NumPy")
+    characters = [c for c in characters if isinstance(c, dict) and 'id' in c]
+    chunks = _chunks(pairings([c['id'] for c in characters], mode), chunk_size)
+    results = []
+    if workers == 1:
+        _init_worker(characters)
+        for chunk in chunks:
+            results.extend(_run_chunk(chunk, battles, seed, engine))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(characters,)) as executor:
+            # map 按提交顺序返回结果，合并顺序与 worker 数无关
+            for chunk_results in executor.map(_run_chunk, chunks, itertools.repeat(battles), itertools.repeat(seed), itertools.repeat(engine)):
+                results.extend(chunk_results)
+    head_to_head, standings = merge_results(results)
+    return {
+        "mode": mode,
+        "seed": seed,
+        "battles_per_pairing": battles,
+        "pairings": results,
+        "head_to_head": head_to_head,
+        "standings": standings,
+    }
+
+def main(argv=None):
+    from repository import repository
+
+    parser = argparse.ArgumentParser(description="Round-robin tournament over characters.json")
+    parser.add_argument('--mode', choices=['1v1', '2v2'], default='1v1')
+    parser.add_argument('--battles', type=int, default=1000, help="battles per pairing")
+    parser.add_argument('--seed', default='0', help="master seed")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='python',
+                        help="batch simulator; 'lockstep' needs NumPy and is much faster for large --battles, "
+                             "'battle' runs the real battle engine to validate the others")
+    parser.add_argument('--output', default='data/tournament.json')
+    args = parser.parse_args(argv)
+
+    result = run_tournament(repository.all(), args.mode, args.battles, args.seed, args.workers, args.chunk_size, args.engine)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    for char_id, record in sorted(result["standings"].items(), key=lambda item: -item[1]["wins"]):
+        print(f"{char_id}: {record['wins']}胜 {record['losses']}负 {record['draws']}平")
+
+if __name__ == '__main__':
+    main()
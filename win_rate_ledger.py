@@ -0,0 +1,157 @@
+"""Append-only win-rate ledger.
+
+Battle outcomes are recorded as deltas. A background thread coalesces them
+and appends one NDJSON line per flush to ``win_rates.log``; the log is
+periodically compacted into the ``win_rates.json`` snapshot, which keeps the
+format the index page has always read. Reads are served from an in-memory
+aggregate (snapshot + log + this process's unflushed deltas).
+
+Appends and log reads hold a shared advisory lock (persistence.file_lock),
+compaction an exclusive one, so several worker processes can record
+concurrently without losing increments.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from persistence import atomic_write_json, file_lock, truncate
+
+FLUSH_INTERVAL = 1.0 # 秒
+COMPACT_BYTES = 256 * 1024 # 日志超过该大小时压缩进快照
+
+class WinRateLedger:
+    def __init__(self, snapshot_path, log_path=None, flush_interval=FLUSH_INTERVAL, compact_bytes=COMPACT_BYTES):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path or os.path.splitext(snapshot_path)[0] + '.log'
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._totals = {} # 磁盘上的状态：快照 + 已读取的日志
+        self._pending = {} # 本进程尚未写入日志的增量 {id: [battles, wins]}
+        self._snapshot_signature = None
+        self._log_offset = 0
+        self._thread = None
+
+    def _file_lock(self, exclusive=False):
+        return file_lock(self.snapshot_path, exclusive=exclusive)
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return {}
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print(f"Error: Could not decode JSON from {self.snapshot_path}")
+            return {}
+
+    @staticmethod
+    def _apply(totals, deltas):
+        for char_id, (battles, wins) in deltas.items():
+            record = totals.setdefault(char_id, {"total_battles": 0, "wins": 0})
+            record["total_battles"] += battles
+            record["wins"] += wins
+
+    def _refresh(self):
+        """Brings the on-disk aggregate up to date. Caller holds the shared file lock."""
+        signature = self._signature(self.snapshot_path)
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if signature != self._snapshot_signature or log_size < self._log_offset:
+            self._totals = self._load_snapshot()
+            self._snapshot_signature = signature
+            self._log_offset = 0
+        if log_size == self._log_offset:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1 # 只处理完整的行
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply(self._totals, json.loads(line))
+        self._log_offset += end
+
+    def load(self):
+        """Returns {char_id: {"total_battles", "wins"}} including unflushed deltas."""
+        with self._lock:
+            with self._file_lock():
+                self._refresh()
+            win_rates = {char_id: dict(record) for char_id, record in self._totals.items()}
+            self._apply(win_rates, self._pending)
+            return win_rates
+
+    def record(self, winner_ids=(), loser_ids=()):
+        """Records one battle: winners gain a battle and a win, losers (or draws) a battle."""
+        with self._lock:
+            for char_id in winner_ids:
+                delta = self._pending.setdefault(str(char_id), [0, 0])
+                delta[0] += 1
+                delta[1] += 1
+            for char_id in loser_ids:
+                self._pending.setdefault(str(char_id), [0, 0])[0] += 1
+            self._ensure_flusher()
+
+    def flush(self):
+        """Appends the coalesced pending deltas as one log line."""
+        with self._lock:
+            if not self._pending:
+                return
+            line = (json.dumps(self._pending, separators=(',', ':')) + '\n').encode('utf-8')
+            os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+            with self._file_lock():
+                fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+                self._pending = {}
+                self._refresh()
+            if self._log_offset >= self.compact_bytes:
+                self.compact()
+
+    def compact(self):
+        """Folds the log into the snapshot and truncates the log."""
+        with self._lock:
+            with self._file_lock(exclusive=True):
+                self._snapshot_signature = None # 强制完整重读
+                self._refresh()
+                atomic_write_json(self.snapshot_path, self._totals)
+                truncate(self.log_path)
+                self._snapshot_signature = self._signature(self.snapshot_path)
+                self._log_offset = 0
+
+    def replace(self, win_rates):
+        """Overwrites all win rates (used by the legacy save_win_rates)."""
+        with self._lock:
+            self._pending = {}
+            with self._file_lock(exclusive=True):
+                atomic_write_json(self.snapshot_path, win_rates)
+                truncate(self.log_path)
+                self._totals = {char_id: dict(record) for char_id, record in win_rates.items()}
+                self._snapshot_signature = self._signature(self.snapshot_path)
+                self._log_offset = 0
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._thread is None:
+            atexit.register(self.flush)
+        self._thread = threading.Thread(target=self._flush_loop, name='win-rate-ledger', daemon=True)
+        self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error: Could not flush win rates: {e}")